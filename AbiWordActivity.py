@@ -19,12 +19,16 @@
 from gettext import gettext as _
 import logging
 import os
+import time
+import signal
+import functools
 
 # Abiword needs this to happen as soon as possible
 from gi.repository import GObject
 GObject.threads_init()
 
 from gi.repository import Gtk
+from gi.repository import GLib
 from gi.repository import GConf
 import telepathy
 import telepathy.client
@@ -47,7 +51,20 @@ from toolbar import InsertToolbar
 from toolbar import ParagraphToolbar
 from widgets import ExportButtonFactory
 from widgets import DocumentView
+from widgets import PaintStatsOverlay
+from widgets import OutlinePanel
+from thumbnails import PageThumbnailPanel
+from inputsession import SessionRecorder
+from inputsession import RECORD_SESSION_ENV
+import perfstats
+from perfstats import timed
+from imagestore import run_in_thread
+from imagestore import run_all_in_threads
+from imagestore import prepare_image
+from imagestore import MAX_IMAGE_SIZE
+from imagestore import ImageStore
 from sugar3.graphics.objectchooser import ObjectChooser
+from sugar3.datastore import datastore
 try:
     from sugar3.graphics.objectchooser import FILTER_TYPE_GENERIC_MIME
 except:
@@ -56,6 +73,16 @@ except:
 logger = logging.getLogger('write-activity')
 
 
+def _unprepared_image(source):
+    # insert the original file if it could not be prepared, as libabiword
+    # may still know its format
+    if not isinstance(source, basestring) or not os.path.exists(source):
+        return None
+    size = os.path.getsize(source)
+    return {'file_path': source, 'original_path': None,
+            'original_bytes': size, 'bytes': size}
+
+
 class ConnectingBox(Gtk.VBox):
 
     def __init__(self):
@@ -71,6 +98,32 @@ class ConnectingBox(Gtk.VBox):
         self.hide()
 
 
+class PendingImagesBox(Gtk.HBox):
+    """Placeholder displayed while images are prepared to be inserted"""
+
+    def __init__(self):
+        Gtk.HBox.__init__(self)
+        self.props.halign = Gtk.Align.CENTER
+        self.props.valign = Gtk.Align.END
+        self.set_margin_bottom(style.GRID_CELL_SIZE)
+        self._pending = 0
+        spinner = Gtk.Spinner()
+        spinner.start()
+        self.pack_start(spinner, False, False, style.DEFAULT_PADDING)
+        self.pack_start(Gtk.Label(_('Inserting image...')), False, False,
+                        style.DEFAULT_PADDING)
+
+    def add_pending(self):
+        self._pending += 1
+        self.show_all()
+
+    def remove_pending(self):
+        self._pending -= 1
+        if self._pending <= 0:
+            self._pending = 0
+            self.hide()
+
+
 class AbiWordActivity(activity.Activity):
 
     def __init__(self, handle):
@@ -82,6 +135,14 @@ class AbiWordActivity(activity.Activity):
         # create our main abiword canvas
         self.abiword_canvas = DocumentView()
         self._new_instance = True
+
+        # record the session, need be done before create the toolbars
+        self._session_recorder = None
+        session_path = os.environ.get(RECORD_SESSION_ENV)
+        if session_path:
+            self._session_recorder = SessionRecorder(self.abiword_canvas,
+                                                     session_path)
+
         toolbar_box = ToolbarBox()
 
         self.activity_button = ActivityToolbarButton(self)
@@ -100,7 +161,12 @@ class AbiWordActivity(activity.Activity):
         toolbar_box.toolbar.insert(edit_toolbar, -1)
 
         view_toolbar = ToolbarButton()
-        view_toolbar.props.page = ViewToolbar(self.abiword_canvas)
+        self._outline_panel = OutlinePanel(self.abiword_canvas)
+        self._thumbnail_panel = PageThumbnailPanel(self.abiword_canvas)
+        self._view_toolbar = ViewToolbar(self.abiword_canvas,
+                                         self._outline_panel,
+                                         self._thumbnail_panel)
+        view_toolbar.props.page = self._view_toolbar
         view_toolbar.props.icon_name = 'toolbar-view'
         view_toolbar.props.label = _('View')
         toolbar_box.toolbar.insert(view_toolbar, -1)
@@ -127,7 +193,7 @@ class AbiWordActivity(activity.Activity):
         toolbar_box.toolbar.insert(para_toolbar, -1)
 
         insert_toolbar = ToolbarButton()
-        insert_toolbar.props.page = InsertToolbar(self.abiword_canvas)
+        insert_toolbar.props.page = InsertToolbar(self.abiword_canvas, self)
         insert_toolbar.props.icon_name = 'insert-table'
         insert_toolbar.props.label = _('Table')
         toolbar_box.toolbar.insert(insert_toolbar, -1)
@@ -144,8 +210,13 @@ class AbiWordActivity(activity.Activity):
         image_floating_checkbutton.connect(
             'toggled', self._image_floating_checkbutton_toggled_cb)
         content_box.pack_start(image_floating_checkbutton, True, True, 0)
+        image_several_checkbutton = Gtk.CheckButton(_('Several images'))
+        image_several_checkbutton.connect(
+            'toggled', self._image_several_checkbutton_toggled_cb)
+        content_box.pack_start(image_several_checkbutton, True, True, 0)
         content_box.show_all()
         self.floating_image = False
+        self.several_images = False
 
         separator = Gtk.SeparatorToolItem()
         separator.props.draw = False
@@ -168,7 +239,27 @@ class AbiWordActivity(activity.Activity):
         self._connecting_box = ConnectingBox()
         overlay.add_overlay(self._connecting_box)
 
-        self.set_canvas(overlay)
+        self.pending_images_box = PendingImagesBox()
+        overlay.add_overlay(self.pending_images_box)
+
+        if os.environ.get(perfstats.PAINT_STATS_ENV) == 'overlay':
+            stats_overlay = PaintStatsOverlay(self.abiword_canvas)
+            stats_overlay.show()
+            overlay.add_overlay(stats_overlay)
+        if self.abiword_canvas.get_paint_stats() is not None or \
+                perfstats.action_stats is not None:
+            # kill -USR1 dumps the statistics in the instance directory
+            GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1,
+                                 self.__dump_stats_cb)
+
+        # the side panels are hidden until enabled in the view toolbar
+        canvas_box = Gtk.HBox()
+        canvas_box.pack_start(self._outline_panel, False, False, 0)
+        canvas_box.pack_start(overlay, True, True, 0)
+        canvas_box.pack_start(self._thumbnail_panel, False, False, 0)
+        canvas_box.show()
+
+        self.set_canvas(canvas_box)
 
         # we want a nice border so we can select paragraphs easily
         self.abiword_canvas.set_show_margin(True)
@@ -184,6 +275,23 @@ class AbiWordActivity(activity.Activity):
         if self._default_font_size == 0:
             self._default_font_size = 12
 
+        # Read the images settings
+        self._max_image_size = client.get_int(
+            '/desktop/sugar/activities/write/max_image_size')
+        if self._max_image_size == 0:
+            self._max_image_size = MAX_IMAGE_SIZE
+        self._keep_original_images = client.get_bool(
+            '/desktop/sugar/activities/write/keep_original_images')
+
+        # Read the number of pages to switch to the draft layout
+        draft_layout_pages = client.get_int(
+            '/desktop/sugar/activities/write/draft_layout_pages')
+        if draft_layout_pages > 0:
+            self._view_toolbar.set_draft_layout_pages(draft_layout_pages)
+        self._image_stats = {'count': 0, 'original_bytes': 0, 'bytes': 0}
+        self.image_store = ImageStore(self.get_instance_dir())
+        self.connect('destroy', self.__destroy_cb)
+
         # activity sharing
         self.participants = {}
         self.joined = False
@@ -212,8 +320,6 @@ class AbiWordActivity(activity.Activity):
         self.abiword_canvas.show()
         self.connect_after('map-event', self.__map_activity_event_cb)
 
-        self.abiword_canvas.connect('size-allocate', self.size_allocate_cb)
-
     def _init_speech(self):
         import speech
         from speechtoolbar import SpeechToolbar
@@ -222,8 +328,18 @@ class AbiWordActivity(activity.Activity):
             self.speech_toolbar_button.set_page(self.speech_toolbar)
             self.speech_toolbar_button.show()
 
-    def size_allocate_cb(self, abi, alloc):
-        GObject.idle_add(abi.queue_draw)
+    def __dump_stats_cb(self):
+        file_path = os.path.join(self.get_activity_root(), 'instance',
+                                 'perfstats-%i.json' % time.time())
+        logger.error('Writing performance statistics to %s', file_path)
+        stats = {'paint': self.abiword_canvas.get_paint_stats(),
+                 'version': self.abiword_canvas.get_version()}
+        if perfstats.action_stats is not None:
+            stats['actions'] = perfstats.action_stats.to_dict()
+        stats['images'] = self._image_stats
+        stats['toolbar-state'] = self.abiword_canvas.state.get_stats()
+        perfstats.dump(file_path, stats)
+        return True
 
     def __map_activity_event_cb(self, event, activity):
         # set custom keybindings for Write
@@ -244,7 +360,8 @@ class AbiWordActivity(activity.Activity):
             self.abiword_canvas.select_bod()
         if hasattr(self.abiword_canvas, 'toggle_rulers'):
             # this is not available yet on upstream abiword
-            self.abiword_canvas.view_print_layout()
+            self.abiword_canvas.set_draft_layout(
+                self.abiword_canvas.get_draft_layout())
             self.abiword_canvas.toggle_rulers(False)
 
         self.abiword_canvas.grab_focus()
@@ -435,6 +552,7 @@ class AbiWordActivity(activity.Activity):
         self.abiword_canvas.zoom_width()
         self._new_instance = False
 
+    @timed('AbiWordActivity.write_file')
     def write_file(self, file_path):
         logging.debug('AbiWordActivity.write_file: %s, mimetype: %s',
                       file_path, self.metadata['mime_type'])
@@ -459,6 +577,14 @@ class AbiWordActivity(activity.Activity):
             self.metadata['fulltext'] = self.abiword_canvas.get_content(
                 'text/plain', None)[:3000]
 
+        self.image_store.collect()
+
+    def __destroy_cb(self, widget):
+        self.abiword_canvas.discard_batch_undo()
+        self.image_store.close()
+        if self._session_recorder is not None:
+            self._session_recorder.close()
+
     def _is_plain_text(self, mime_type):
         # These types have 'text/plain' in their mime_parents  but we need
         # use it like rich text
@@ -474,14 +600,45 @@ class AbiWordActivity(activity.Activity):
     def _image_floating_checkbutton_toggled_cb(self, checkbutton):
         self.floating_image = checkbutton.get_active()
 
+    def _image_several_checkbutton_toggled_cb(self, checkbutton):
+        self.several_images = checkbutton.get_active()
+
     def _image_cb(self, button):
+        if not self.several_images:
+            jobject = self._choose_image()
+            if jobject is not None:
+                self.insert_image(jobject.file_path, self.floating_image,
+                                  jobject)
+            return
+
+        # the sugar3 object chooser has no multiple selection, ask again
+        # until it is cancelled, and insert all the images together
+        jobjects = []
+        while True:
+            jobject = self._choose_image()
+            if jobject is None:
+                break
+            jobjects.append(jobject)
+        if jobjects:
+            self.insert_images([jobject.file_path for jobject in jobjects],
+                               self.floating_image, jobjects)
+
+    def _choose_image(self):
+        return self._choose_object('Image', True)
+
+    def choose_text_file(self):
+        """Let the user choose a text file in the journal, like a CSV"""
+        # the generic 'Text' type doesn't include text/csv
+        return self._choose_object(None, False)
+
+    def _choose_object(self, what_filter, show_preview):
         try:
-            chooser = ObjectChooser(self, what_filter='Image',
+            chooser = ObjectChooser(self, what_filter=what_filter,
                                     filter_type=FILTER_TYPE_GENERIC_MIME,
-                                    show_preview=True)
+                                    show_preview=show_preview)
         except:
             # for compatibility with older versions
-            chooser = ObjectChooser(self, what_filter='Image')
+            chooser = ObjectChooser(self, what_filter=what_filter)
 
         try:
             result = chooser.run()
@@ -490,8 +647,88 @@ class AbiWordActivity(activity.Activity):
                               chooser.get_selected_object())
                 jobject = chooser.get_selected_object()
                 if jobject and jobject.file_path:
-                    self.abiword_canvas.insert_image(jobject.file_path,
-                                                     self.floating_image)
+                    return jobject
+            return None
         finally:
             chooser.destroy()
             del chooser
+
+    def get_instance_dir(self):
+        instance_dir = os.path.join(self.get_activity_root(), 'instance')
+        if not os.path.exists(instance_dir):
+            os.makedirs(instance_dir)
+        return instance_dir
+
+    def insert_image(self, source, floating, jobject=None):
+        """
+        Insert an image from a file path or a pixbuf, downscaled and
+        recompressed in a worker thread. jobject is kept alive until
+        the image file has been read.
+        """
+        self.pending_images_box.add_pending()
+        run_in_thread(prepare_image,
+                      (source, self.image_store, self._max_image_size,
+                       self._keep_original_images),
+                      functools.partial(self.__image_prepared_cb, source,
+                                        floating, jobject))
+
+    def __image_prepared_cb(self, source, floating, jobject, result, error):
+        self.pending_images_box.remove_pending()
+        if error is not None:
+            result = _unprepared_image(source)
+            if result is None:
+                return
+
+        self.abiword_canvas.insert_image(result['file_path'], floating)
+        self._image_inserted(result)
+
+    def insert_images(self, sources, floating, jobjects=None):
+        """
+        Insert several images, prepared concurrently, once all of them
+        are ready, painted once and undone together.
+        """
+        for source in sources:
+            self.pending_images_box.add_pending()
+        run_all_in_threads(prepare_image,
+                           [(source, self.image_store, self._max_image_size,
+                             self._keep_original_images)
+                            for source in sources],
+                           functools.partial(self.__images_prepared_cb,
+                                             sources, floating, jobjects))
+
+    def __images_prepared_cb(self, sources, floating, jobjects, results,
+                             errors):
+        for result in results:
+            self.pending_images_box.remove_pending()
+        results = [_unprepared_image(source) if error is not None else result
+                   for source, result, error in zip(sources, results, errors)]
+        results = [result for result in results if result is not None]
+        if not results:
+            return
+
+        self.abiword_canvas.insert_images(
+            [result['file_path'] for result in results], floating)
+        for result in results:
+            self._image_inserted(result)
+
+    def _image_inserted(self, result):
+        self._image_stats['count'] += 1
+        self._image_stats['original_bytes'] += result['original_bytes']
+        self._image_stats['bytes'] += result['bytes']
+        logger.debug('Image inserted, %d bytes saved (%d in this session)',
+                     result['original_bytes'] - result['bytes'],
+                     self._image_stats['original_bytes'] -
+                     self._image_stats['bytes'])
+
+        if result['original_path'] is not None:
+            self._keep_original_image(result['original_path'])
+
+    def _keep_original_image(self, file_path):
+        jobject = datastore.create()
+        jobject.metadata['title'] = _('%s (original image)') % \
+            self.metadata['title']
+        jobject.metadata['mime_type'] = 'image/png'
+        jobject.metadata['icon-color'] = self.metadata['icon-color']
+        jobject.file_path = file_path
+        datastore.write(jobject, transfer_ownership=True)
+        jobject.destroy()
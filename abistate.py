@@ -0,0 +1,175 @@
+# Copyright (C) 2015 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+from collections import OrderedDict
+
+from gi.repository import GLib
+
+# signals reporting an event rather than a state, always dispatched even
+# if the arguments are the same as the last time
+EVENT_SIGNALS = ('text-selected', 'image-selected', 'selection-cleared')
+
+
+class _Handler(object):
+
+    def __init__(self, handler_id, widget, signal, callback, args):
+        self.id = handler_id
+        self.widget = widget
+        self.signal = signal
+        self.callback = callback
+        self.args = args
+        # the signal arguments of the last call, or the emission for the
+        # event signals
+        self.applied = None
+        self.blocked = 0
+
+
+class StateAggregator(object):
+    """
+    Dispatch the state signals of the abiword canvas to the toolbars.
+
+    Every cursor movement emits a burst of signals, the aggregator only
+    records the last value of every signal, and once per frame calls the
+    handlers whose value changed, or of the event signals emitted again
+    like text-selected. The handlers belong to a widget, and
+    are not called while the widget is not visible, they are called with
+    the last values when it is shown again.
+
+    connect() and handler_block() work as in GObject, with the widget as
+    first argument of connect().
+    """
+
+    def __init__(self, abi):
+        self._abi = abi
+        # last arguments of every signal and the key compared to know if
+        # it changed, ordered by emission
+        self._values = OrderedDict()
+        self._emissions = 0
+        self._dirty = set()
+        self._handlers = {}
+        self._blocked = set()
+        self._widgets = set()
+        self._next_id = 1
+        self._flush_pending = False
+        self._stats = {'emitted': 0, 'dispatched': 0, 'unchanged': 0,
+                       'hidden': 0, 'flushes': 0}
+
+    def connect(self, widget, signal, callback, *args):
+        if signal not in self._handlers:
+            self._handlers[signal] = []
+            self._abi.connect(signal, self.__signal_cb, signal)
+        handler = _Handler(self._next_id, widget, signal, callback, args)
+        self._next_id += 1
+        self._handlers[signal].append(handler)
+        if widget not in self._widgets:
+            self._widgets.add(widget)
+            widget.connect('map', self.__map_cb)
+            widget.connect('destroy', self.__destroy_cb)
+        return handler.id
+
+    def _find_handler(self, handler_id):
+        for handlers in self._handlers.values():
+            for handler in handlers:
+                if handler.id == handler_id:
+                    return handler
+        raise ValueError('Unknown handler %d' % handler_id)
+
+    def handler_block(self, handler_id):
+        handler = self._find_handler(handler_id)
+        handler.blocked += 1
+        self._blocked.add(handler)
+
+    def handler_unblock(self, handler_id):
+        handler = self._find_handler(handler_id)
+        handler.blocked -= 1
+        if handler.blocked == 0:
+            self._blocked.discard(handler)
+
+    def __signal_cb(self, abi, *args):
+        signal = args[-1]
+        args = args[:-1]
+        self._stats['emitted'] += 1
+        self._emissions += 1
+        key = self._emissions if signal in EVENT_SIGNALS else args
+        self._values.pop(signal, None)
+        self._values[signal] = (args, key)
+        self._dirty.add(signal)
+        # the emissions while blocked are not dispatched later
+        for handler in self._blocked:
+            if handler.signal == signal:
+                handler.applied = key
+        self._queue_flush()
+
+    def _queue_flush(self):
+        if self._flush_pending:
+            return
+        self._flush_pending = True
+        if hasattr(self._abi, 'add_tick_callback') and \
+                self._abi.get_realized():
+            self._abi.add_tick_callback(self.__flush_tick_cb)
+        else:
+            # before gtk 3.8
+            GLib.idle_add(self.__flush_idle_cb)
+
+    def __flush_tick_cb(self, widget, frame_clock):
+        self.flush()
+        return False
+
+    def __flush_idle_cb(self):
+        self.flush()
+        return False
+
+    def flush(self):
+        """Call the handlers of the signals emitted since the last flush"""
+        self._flush_pending = False
+        if not self._dirty:
+            return
+        self._stats['flushes'] += 1
+        dirty = self._dirty
+        self._dirty = set()
+        for signal, (args, key) in self._values.items():
+            if signal in dirty:
+                for handler in self._handlers[signal]:
+                    self._dispatch(handler, args, key)
+
+    def _dispatch(self, handler, args, key):
+        if handler.applied == key:
+            self._stats['unchanged'] += 1
+        elif not handler.widget.get_mapped():
+            # updated when shown
+            self._stats['hidden'] += 1
+        else:
+            handler.applied = key
+            self._stats['dispatched'] += 1
+            handler.callback(self._abi, *(args + handler.args))
+
+    def __map_cb(self, widget):
+        for signal, (args, key) in self._values.items():
+            for handler in self._handlers[signal]:
+                if handler.widget == widget:
+                    self._dispatch(handler, args, key)
+
+    def __destroy_cb(self, widget):
+        self._widgets.discard(widget)
+        for signal in self._handlers:
+            self._handlers[signal] = [handler for handler in
+                                      self._handlers[signal] if
+                                      handler.widget != widget]
+        self._blocked = set(handler for handler in self._blocked if
+                            handler.widget != widget)
+
+    def get_stats(self):
+        return dict(self._stats)
@@ -0,0 +1,259 @@
+# Copyright (C) 2015 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Stand-in for Abi.Widget, to exercise the toolbars without libabiword.
+
+FakeAbiWidget emits the same signals the toolbars connect to, and the
+methods they call update a minimal document state and emit the
+signals back, like libabiword does.
+"""
+
+from gi.repository import Gtk
+from gi.repository import GObject
+
+from abistate import StateAggregator
+
+_BOOL = (GObject.SignalFlags.RUN_LAST, None, [bool])
+_INT = (GObject.SignalFlags.RUN_LAST, None, [int])
+_STR = (GObject.SignalFlags.RUN_LAST, None, [str])
+
+
+class FakeAbiWidget(Gtk.DrawingArea):
+
+    __gsignals__ = {
+        'bold': _BOOL,
+        'italic': _BOOL,
+        'underline': _BOOL,
+        'overline': _BOOL,
+        'line-through': _BOOL,
+        'topline': _BOOL,
+        'bottomline': _BOOL,
+        'subscript': _BOOL,
+        'superscript': _BOOL,
+        'left-align': _BOOL,
+        'right-align': _BOOL,
+        'center-align': _BOOL,
+        'justify-align': _BOOL,
+        'can-undo': _BOOL,
+        'can-redo': _BOOL,
+        'is-dirty': _BOOL,
+        'table-state': _BOOL,
+        'text-selected': _BOOL,
+        'image-selected': _BOOL,
+        'selection-cleared': _BOOL,
+        'font-size': _STR,
+        'font-family': _STR,
+        'style-name': _STR,
+        'page-count': _INT,
+        'current-page': _INT,
+        'zoom': _INT,
+        'color': (GObject.SignalFlags.RUN_LAST, None, [int, int, int]),
+        'enter-selection': _BOOL,
+        'leave-selection': _BOOL, }
+
+    def __init__(self, version='3.0'):
+        Gtk.DrawingArea.__init__(self)
+        self._version = version
+        self._state = {'bold': False, 'italic': False, 'underline': False}
+        self._style = 'Normal'
+        self._zoom = 100
+        self._page = 1
+        self._page_count = 1
+        self._find_string = ''
+        self._draft_layout = False
+        self.calls = {}
+        self.state = StateAggregator(self)
+
+    def _record(self, name):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def _toggle(self, prop):
+        self._record('toggle_' + prop)
+        self._state[prop] = not self._state[prop]
+        self.emit(prop, self._state[prop])
+
+    def get_version(self):
+        return self._version
+
+    def toggle_bold(self):
+        self._toggle('bold')
+
+    def toggle_italic(self):
+        self._toggle('italic')
+
+    def toggle_underline(self):
+        self._toggle('underline')
+
+    def set_style(self, style_name):
+        self._record('set_style')
+        self._style = style_name
+        self.emit('style-name', style_name)
+
+    def set_font_name(self, font_name):
+        self._record('set_font_name')
+        self.emit('font-family', font_name)
+
+    def set_font_size(self, font_size):
+        self._record('set_font_size')
+        self.emit('font-size', font_size)
+
+    def set_text_color(self, red, green, blue):
+        self._record('set_text_color')
+        self.emit('color', red, green, blue)
+
+    def _align(self, signal):
+        self._record(signal)
+        for name in ('left-align', 'center-align', 'right-align',
+                     'justify-align'):
+            self.emit(name, name == signal)
+
+    def align_left(self):
+        self._align('left-align')
+
+    def align_center(self):
+        self._align('center-align')
+
+    def align_right(self):
+        self._align('right-align')
+
+    def align_justify(self):
+        self._align('justify-align')
+
+    def set_zoom_percentage(self, zoom):
+        self._record('set_zoom_percentage')
+        self._zoom = zoom
+        self.emit('zoom', zoom)
+
+    def get_zoom_percentage(self):
+        return self._zoom
+
+    def zoom_width(self):
+        self.set_zoom_percentage(100)
+
+    def set_current_page(self, page):
+        self._record('set_current_page')
+        self._page = max(1, min(page, self._page_count))
+        self.emit('current-page', self._page)
+
+    def get_current_page_num(self):
+        return self._page
+
+    def set_page_count(self, count):
+        """Not in Abi.Widget, used to simulate a document of count pages"""
+        self._page_count = count
+        self.emit('page-count', count)
+
+    def set_find_string(self, find_string):
+        self._record('set_find_string')
+        self._find_string = find_string
+
+    def find_next(self, select=False):
+        self._record('find_next')
+        return bool(self._find_string)
+
+    def find_prev(self):
+        self._record('find_prev')
+        return bool(self._find_string)
+
+    def insert_table(self, rows, cols):
+        self._record('insert_table')
+        self.emit('table-state', True)
+
+    def insert_image(self, file_path, floating):
+        self._record('insert_image')
+        self.emit('image-selected', True)
+
+    def invoke_ex(self, method, data, x, y):
+        self._record('invoke_ex:' + method)
+        return True
+
+    def get_content(self, mime_type, extra):
+        self._record('get_content')
+        return ''
+
+    def save(self, uri, mime_type, extra):
+        self._record('save')
+        return True
+
+    def copy(self):
+        self._record('copy')
+
+    def paste(self):
+        self._record('paste')
+
+    def undo(self):
+        self._record('undo')
+
+    def redo(self):
+        self._record('redo')
+
+    def select_all(self):
+        self._record('select_all')
+
+    def moveto_bod(self):
+        self._record('moveto_bod')
+
+    # the DocumentView api used by the toolbars, as when libabiword can't
+    # provide the document text
+
+    def get_revision(self):
+        return 0
+
+    def get_snapshot(self):
+        return None
+
+    def get_cursor_offset(self):
+        return None
+
+    def get_find_string(self):
+        return self._find_string
+
+    def select_occurrence(self, text, occurrence, total):
+        self._record('select_occurrence')
+        return True
+
+    def select_next_occurrence(self, text, skipped, occurrence):
+        self._record('select_next_occurrence')
+        return True
+
+    def replace_all(self, pattern, replacement, regex):
+        self._record('replace_all')
+        return None
+
+    def can_undo_batch(self):
+        return False
+
+    def insert_table_with_data(self, rows):
+        self._record('insert_table_with_data')
+        self.emit('table-state', True)
+        return True
+
+    def invoke_repeated(self, method, count):
+        self._record('invoke_repeated:' + method)
+
+    def request_zoom(self, zoom):
+        self.set_zoom_percentage(zoom)
+
+    def can_draft_layout(self):
+        return True
+
+    def set_draft_layout(self, draft):
+        self._record('set_draft_layout')
+        self._draft_layout = draft
+
+    def get_draft_layout(self):
+        return self._draft_layout
@@ -16,12 +16,16 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 import os
+import json
+from collections import OrderedDict
 import shutil
+import logging
 from gettext import gettext as _
 
 from gi.repository import Gtk
 from gi.repository import GObject
 from gi.repository import Gio
+from gi.repository import GLib
 
 from sugar3.graphics.icon import Icon
 from sugar3.graphics.palette import Palette, ToolInvoker
@@ -34,6 +38,118 @@ DEFAULT_FONTS = ['Sans', 'Serif', 'Monospace']
 USER_FONTS_FILE_PATH = env.get_profile_path('fonts')
 GLOBAL_FONTS_FILE_PATH = '/etc/sugar_fonts'
 
+# the fontconfig caches are rewritten when the installed fonts change
+FONTCONFIG_CACHE_DIRS = ['/var/cache/fontconfig',
+                         os.path.join(GLib.get_user_cache_dir(), 'fontconfig'),
+                         os.path.expanduser('~/.fontconfig')]
+FONT_CATALOG_PATH = os.path.join(GLib.get_user_cache_dir(), 'write-activity',
+                                 'font-catalog.json')
+
+# font families displayed in their own font at the same time in the palette
+MAX_FONT_PREVIEWS = 40
+
+logger = logging.getLogger('write-activity')
+
+
+def _get_files_state(paths):
+    state = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            state.append([path, stat.st_mtime, stat.st_size])
+        except OSError:
+            state.append([path, None, None])
+    return state
+
+
+def _utf8(name):
+    """
+    Return a font family name as an utf-8 str, like the names listed by
+    Pango and read from the white list files. The names loaded from the
+    json catalog are unicode, and would not match the white list.
+
+    >>> _utf8(u'Caf\\xe9 Sans') == 'Caf\\xc3\\xa9 Sans'
+    True
+    >>> _utf8('Caf\\xc3\\xa9 Sans') == 'Caf\\xc3\\xa9 Sans'
+    True
+    >>> _filter_white_list([u'Caf\\xe9 Sans', u'Sans', u'Serif'],
+    ...                    set(['Caf\\xc3\\xa9 Sans', 'Serif']))
+    ['Caf\\xc3\\xa9 Sans', 'Serif']
+    """
+    if isinstance(name, unicode):
+        return name.encode('utf-8')
+    return name
+
+
+def _filter_white_list(families, white_list):
+    return [name for name in (_utf8(family) for family in families)
+            if name in white_list]
+
+
+def read_white_list():
+    """Return the set of font families allowed"""
+    white_list = set(DEFAULT_FONTS)
+    if os.path.exists(USER_FONTS_FILE_PATH):
+        fonts_file = open(USER_FONTS_FILE_PATH)
+        try:
+            for line in fonts_file:
+                if line.strip():
+                    white_list.add(_utf8(line.strip()))
+        finally:
+            fonts_file.close()
+    return white_list
+
+
+def get_font_catalog(pango_context, white_list):
+    """
+    Return the sorted list of all the font families, and of the families
+    in the white list. Both are cached on disk, the families are listed
+    again only if the fontconfig caches changed, and filtered again if
+    the white list files changed too.
+    """
+    fontconfig_state = _get_files_state(FONTCONFIG_CACHE_DIRS)
+    white_list_state = _get_files_state([USER_FONTS_FILE_PATH,
+                                         GLOBAL_FONTS_FILE_PATH])
+    catalog = {}
+    try:
+        catalog_file = open(FONT_CATALOG_PATH)
+        try:
+            catalog = json.load(catalog_file)
+        finally:
+            catalog_file.close()
+    except (IOError, ValueError):
+        pass
+
+    if catalog.get('fontconfig') == fontconfig_state and \
+            catalog.get('white_lists') == white_list_state:
+        return ([_utf8(name) for name in catalog['families']],
+                [_utf8(name) for name in catalog['fonts']])
+
+    if catalog.get('fontconfig') == fontconfig_state:
+        families = [_utf8(name) for name in catalog['families']]
+    else:
+        logger.debug('Listing the font families')
+        families = sorted(_utf8(family.get_name()) for family in
+                          pango_context.list_families())
+    fonts = _filter_white_list(families, white_list)
+
+    catalog = {'fontconfig': fontconfig_state, 'families': families,
+               'white_lists': white_list_state, 'fonts': fonts}
+    try:
+        directory = os.path.dirname(FONT_CATALOG_PATH)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        temp_path = FONT_CATALOG_PATH + '.tmp'
+        catalog_file = open(temp_path, 'w')
+        try:
+            json.dump(catalog, catalog_file)
+        finally:
+            catalog_file.close()
+        os.rename(temp_path, FONT_CATALOG_PATH)
+    except (IOError, OSError), e:
+        logger.error('Can not write the font catalog: %s', e)
+    return families, fonts
+
 
 class FontLabel(Gtk.Label):
 
@@ -90,41 +206,33 @@ class FontComboBox(Gtk.ToolItem):
         self.palette = Palette(_('Select font'))
         self.palette.set_invoker(self._palette_invoker)
 
-        # load the fonts in the palette menu
+        # the fonts are loaded in the palette menu when first displayed
         self._menu_box = PaletteMenuBox()
         self.props.palette.set_content(self._menu_box)
         self._menu_box.show()
-
-        context = self.get_pango_context()
+        self._menu_items = None
+        # font families displayed in their own font, least recently
+        # displayed first
+        self._previews = OrderedDict()
+        self._previews_id = None
+        self._scrolled_window = None
+        self.palette.connect('popup', self.__palette_popup_cb)
 
         self._init_font_list()
 
-        tmp_list = []
-        for family in context.list_families():
-            name = family.get_name()
-            if name in self._font_white_list:
-                tmp_list.append(name)
-        for name in sorted(tmp_list):
-            self._add_menu(name, self.__font_selected_cb)
-
         self._font_label.set_font(self._font_name)
 
     def _init_font_list(self):
-        self._font_white_list = []
-        self._font_white_list.extend(DEFAULT_FONTS)
-
         # check if there are a user configuration file
         if not os.path.exists(USER_FONTS_FILE_PATH):
             # verify if exists a file in /etc
             if os.path.exists(GLOBAL_FONTS_FILE_PATH):
                 shutil.copy(GLOBAL_FONTS_FILE_PATH, USER_FONTS_FILE_PATH)
 
+        # get the font names in the file to the white list
+        self._font_white_list = read_white_list()
+
         if os.path.exists(USER_FONTS_FILE_PATH):
-            # get the font names in the file to the white list
-            fonts_file = open(USER_FONTS_FILE_PATH)
-            # get the font names in the file to the white list
-            for line in fonts_file:
-                self._font_white_list.append(line.strip())
             # monitor changes in the file
             gio_fonts_file = Gio.File.new_for_path(USER_FONTS_FILE_PATH)
             self.monitor = gio_fonts_file.monitor_file(
@@ -135,37 +243,102 @@ class FontComboBox(Gtk.ToolItem):
     def _reload_fonts(self, monitor, gio_file, other_file, event):
         if event != Gio.FileMonitorEvent.CHANGES_DONE_HINT:
             return
-        self._font_white_list = []
-        self._font_white_list.extend(DEFAULT_FONTS)
-        fonts_file = open(USER_FONTS_FILE_PATH)
-        for line in fonts_file:
-            self._font_white_list.append(line.strip())
-        # update the menu
-        for child in self._menu_box.get_children():
-            self._menu_box.remove(child)
-            child = None
-        context = self.get_pango_context()
-        tmp_list = []
-        for family in context.list_families():
-            name = family.get_name()
-            if name in self._font_white_list:
-                tmp_list.append(name)
-        for name in sorted(tmp_list):
+        self._font_white_list = read_white_list()
+        if self._menu_items is None:
+            # the menu was not displayed yet
+            return False
+
+        # update only the entries of the fonts added or removed, the
+        # font families are not listed again
+        families, fonts = get_font_catalog(self.get_pango_context(),
+                                           self._font_white_list)
+        new_fonts = set(fonts)
+        for font_name in self._menu_items.keys():
+            if font_name not in new_fonts:
+                self._menu_box.remove(self._menu_items.pop(font_name))
+                self._previews.pop(font_name, None)
+        menu_items = OrderedDict()
+        for position, font_name in enumerate(fonts):
+            if font_name not in self._menu_items:
+                self._add_menu(font_name, self.__font_selected_cb)
+                self._menu_box.reorder_child(self._menu_items[font_name],
+                                             position)
+            menu_items[font_name] = self._menu_items[font_name]
+        self._menu_items = menu_items
+        logger.debug('Fonts reloaded, %d fonts', len(fonts))
+        self._queue_previews()
+        return False
+
+    def __palette_popup_cb(self, palette):
+        if self._menu_items is None:
+            self._populate_menu()
+        self._queue_previews()
+
+    def _populate_menu(self):
+        self._menu_items = OrderedDict()
+        families, fonts = get_font_catalog(self.get_pango_context(),
+                                           self._font_white_list)
+        for name in fonts:
             self._add_menu(name, self.__font_selected_cb)
+
+        if self._scrolled_window is None:
+            widget = self._menu_box.get_parent()
+            while widget is not None and \
+                    not isinstance(widget, Gtk.ScrolledWindow):
+                widget = widget.get_parent()
+            if widget is not None:
+                self._scrolled_window = widget
+                widget.get_vadjustment().connect(
+                    'value-changed', lambda adjustment: self._queue_previews())
+
+    def _queue_previews(self):
+        if self._previews_id is None:
+            self._previews_id = GLib.idle_add(self.__previews_idle_cb)
+
+    def __previews_idle_cb(self):
+        self._previews_id = None
+        visible = []
+        for font_name, menu_item in self._menu_items.items():
+            if self._scrolled_window is not None:
+                coords = menu_item.translate_coordinates(
+                    self._scrolled_window, 0, 0)
+                if coords is None:
+                    continue
+                y = coords[1]
+                if y + menu_item.get_allocated_height() < 0 or \
+                        y > self._scrolled_window.get_allocated_height():
+                    continue
+            visible.append(font_name)
+        for font_name in visible[:MAX_FONT_PREVIEWS]:
+            self._show_preview(font_name)
         return False
 
+    def _show_preview(self, font_name):
+        if font_name in self._previews:
+            self._previews[font_name] = self._previews.pop(font_name)
+            return
+        menu_item = self._menu_items[font_name]
+        menu_item.set_label('<span font="%s">%s</span>' %
+                            (font_name, GLib.markup_escape_text(font_name)))
+        self._previews[font_name] = menu_item
+        if len(self._previews) > MAX_FONT_PREVIEWS:
+            # release the least recently displayed font
+            old_font_name, old_menu_item = self._previews.popitem(last=False)
+            old_menu_item.set_label(GLib.markup_escape_text(old_font_name))
+
     def __font_selected_cb(self, menu, font_name):
         self._font_name = font_name
         self._font_label.set_font(font_name)
         self.emit('changed')
 
     def _add_menu(self, font_name, activate_cb):
-        label = '<span font="%s">%s</span>' % (font_name, font_name)
+        # displayed in its own font only when visible
         menu_item = PaletteMenuItem()
-        menu_item.set_label(label)
+        menu_item.set_label(GLib.markup_escape_text(font_name))
         menu_item.connect('activate', activate_cb, font_name)
         self._menu_box.append_item(menu_item)
         menu_item.show()
+        self._menu_items[font_name] = menu_item
 
     def __destroy_cb(self, icon):
         if self._palette_invoker is not None:
@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Load and save benchmarks for the document formats handled by Write.
+
+Synthetic documents are generated in the AbiWord native format, using
+the same paragraph and list styles offered by the ParagraphToolbar, and
+then saved and loaded back in every mime type declared in
+activity/activity.info and every format exported by ExportButtonFactory.
+
+Every measure runs in a separate process, so the peak RSS reported is
+not polluted by the previous cases. Needs a display, use xvfb-run to
+run it headless:
+
+    xvfb-run python formatbench.py --output results.json
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import shutil
+import resource
+import tempfile
+import subprocess
+import ConfigParser
+from optparse import OptionParser
+from xml.sax.saxutils import escape
+
+BUNDLE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+# name: (pages, images per page, tables per page, lists per page)
+SIZES = {'small': (2, 1, 1, 1),
+         'medium': (20, 1, 1, 2),
+         'large': (100, 2, 1, 2)}
+
+PARAGRAPHS_PER_PAGE = 8
+
+PARAGRAPH_STYLES = ['Normal', 'Heading 1', 'Heading 2', 'Heading 3',
+                    'Heading 4', 'Block Text', 'Plain Text']
+
+# style name: libabiword list type
+LIST_STYLES = {'Numbered List': 0,
+               'Lower Case List': 1,
+               'Upper Case List': 2,
+               'Bullet List': 5,
+               'Dashed List': 6}
+
+# mime types libabiword can't export, and the type Write uses instead
+SAVE_FALLBACKS = {'application/msword': 'application/rtf'}
+
+LOREM = 'Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do ' \
+    'eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ' \
+    'ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut ' \
+    'aliquip ex ea commodo consequat. '
+
+
+def get_activity_mime_types():
+    info = ConfigParser.ConfigParser()
+    info.read(os.path.join(BUNDLE_PATH, 'activity', 'activity.info'))
+    return [mime_type.strip() for mime_type in
+            info.get('Activity', 'mime_types').split(';') if mime_type]
+
+
+def get_export_formats():
+    from widgets import ExportButtonFactory
+    return [(format['mime_type'], format['exp_props']) for format in
+            ExportButtonFactory._EXPORT_FORMATS]
+
+
+def _create_png(width, height):
+    from gi.repository import GdkPixbuf
+    pixbuf = GdkPixbuf.Pixbuf.new(GdkPixbuf.Colorspace.RGB, False, 8,
+                                  width, height)
+    pixbuf.fill(0x3366ccff)
+    success, data = pixbuf.save_to_bufferv('png', [], [])
+    return data
+
+
+def generate_document(file_path, pages, images, tables, lists):
+    """Write a synthetic .abw document and return its size in bytes"""
+    png_data = base64.b64encode(_create_png(640, 480))
+    list_styles = sorted(LIST_STYLES.keys())
+
+    body = []
+    data = []
+    list_defs = []
+    for page in range(pages):
+        for n in range(PARAGRAPHS_PER_PAGE):
+            style_name = PARAGRAPH_STYLES[(page + n) % len(PARAGRAPH_STYLES)]
+            body.append('<p style="%s">%s</p>' %
+                        (style_name, escape('%d.%d %s' % (page, n, LOREM))))
+
+        for n in range(images):
+            image_id = 'image-%d-%d' % (page, n)
+            body.append('<p><image dataid="%s" '
+                        'props="width:3in; height:2.25in"/></p>' % image_id)
+            data.append('<d name="%s" mime-type="image/png" '
+                        'base64="yes">%s</d>' % (image_id, png_data))
+
+        for n in range(tables):
+            body.append('<table props="table-column-props:1.5in/1.5in/'
+                        '1.5in/; ">')
+            for row in range(4):
+                for col in range(3):
+                    body.append('<cell props="left-attach:%d; '
+                                'right-attach:%d; top-attach:%d; '
+                                'bot-attach:%d"><p>%d x %d</p></cell>' %
+                                (col, col + 1, row, row + 1, row, col))
+            body.append('</table>')
+
+        for n in range(lists):
+            style_name = list_styles[(page + n) % len(list_styles)]
+            list_id = 1000 + len(list_defs)
+            list_defs.append('<l id="%d" parentid="0" type="%d" '
+                             'start-value="1" list-delim="%%L" '
+                             'list-decimal="."/>' %
+                             (list_id, LIST_STYLES[style_name]))
+            for item in range(5):
+                body.append('<p style="%s" level="1" listid="%d" '
+                            'props="list-style:%s">item %d</p>' %
+                            (style_name, list_id, style_name, item))
+
+    doc = open(file_path, 'w')
+    try:
+        doc.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        doc.write('<abiword xmlns="http://www.abisource.com/awml.dtd" '
+                  'fileformat="1.1">\n')
+        doc.write('<lists>%s</lists>\n' % ''.join(list_defs))
+        doc.write('<section>\n%s\n</section>\n' % '\n'.join(body))
+        doc.write('<data>%s</data>\n' % ''.join(data))
+        doc.write('</abiword>\n')
+    finally:
+        doc.close()
+    return os.path.getsize(file_path)
+
+
+def _peak_rss():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _flush_events():
+    from gi.repository import Gtk
+    while Gtk.events_pending():
+        Gtk.main_iteration()
+
+
+def _create_canvas():
+    from gi.repository import Gtk
+    from widgets import DocumentView
+
+    window = Gtk.OffscreenWindow()
+    canvas = DocumentView()
+    window.add(canvas)
+    window.set_default_size(1024, 768)
+    window.show_all()
+    _flush_events()
+    return canvas
+
+
+def run_case(operation, source, target, mime_type, exp_props):
+    """Measure a single load or save, runs in the child process"""
+    canvas = _create_canvas()
+
+    if operation == 'save':
+        canvas.load_file('file://' + source, '')
+        _flush_events()
+
+    rss_before = _peak_rss()
+    start = time.time()
+    if operation == 'load':
+        canvas.load_file('file://' + source, '')
+    else:
+        canvas.save('file://' + target, mime_type, exp_props)
+    _flush_events()
+    elapsed = time.time() - start
+
+    result = {'wall_time': elapsed,
+              'rss_before_kb': rss_before,
+              'peak_rss_kb': _peak_rss(),
+              'version': canvas.get_version()}
+    if operation == 'save':
+        result['bytes_written'] = os.path.getsize(target)
+    return result
+
+
+def _spawn_case(operation, source, target, mime_type, exp_props):
+    args = [sys.executable, os.path.abspath(__file__), '--case', operation,
+            '--source', source, '--target', target, '--mime-type', mime_type,
+            '--exp-props', exp_props]
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode != 0:
+        return {'error': 'exit code %d' % process.returncode}
+    # libabiword can print to stdout, the result is the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run_benchmarks(sizes, repeat):
+    cases = [(mime_type, '', 'activity') for mime_type in
+             get_activity_mime_types()]
+    cases.extend([(mime_type, exp_props, 'export') for
+                  mime_type, exp_props in get_export_formats()])
+
+    work_dir = tempfile.mkdtemp(prefix='write-formatbench-')
+    results = []
+    try:
+        for size_name in sizes:
+            pages, images, tables, lists = SIZES[size_name]
+            source = os.path.join(work_dir, '%s.abw' % size_name)
+            source_size = generate_document(source, pages, images, tables,
+                                            lists)
+
+            for mime_type, exp_props, origin in cases:
+                saved_as = SAVE_FALLBACKS.get(mime_type, mime_type)
+                target = os.path.join(
+                    work_dir, '%s-%s' % (size_name,
+                                         mime_type.replace('/', '_')))
+                for operation in ('save', 'load'):
+                    if operation == 'load' and origin == 'export':
+                        # exported formats are not opened by Write
+                        continue
+                    for iteration in range(repeat):
+                        if operation == 'load':
+                            result = _spawn_case(operation, target, '',
+                                                 saved_as, exp_props)
+                        else:
+                            result = _spawn_case(operation, source, target,
+                                                 saved_as, exp_props)
+                        result.update({'size': size_name,
+                                       'pages': pages,
+                                       'source_bytes': source_size,
+                                       'mime_type': mime_type,
+                                       'saved_as': saved_as,
+                                       'origin': origin,
+                                       'operation': operation,
+                                       'iteration': iteration})
+                        results.append(result)
+                        sys.stderr.write('%s %s %s: %r\n' % (
+                            size_name, operation, mime_type,
+                            result.get('wall_time', result.get('error'))))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--output', default='formatbench.json',
+                      help='file where the json results are written')
+    parser.add_option('--sizes', default='small,medium,large',
+                      help='comma separated list of %s' %
+                      ', '.join(sorted(SIZES.keys())))
+    parser.add_option('--repeat', type='int', default=3)
+    parser.add_option('--case')
+    parser.add_option('--source')
+    parser.add_option('--target')
+    parser.add_option('--mime-type')
+    parser.add_option('--exp-props', default='')
+    options, args = parser.parse_args()
+
+    if options.case is not None:
+        result = run_case(options.case, options.source, options.target,
+                          options.mime_type, options.exp_props)
+        sys.stdout.write('\n' + json.dumps(result) + '\n')
+        return
+
+    sizes = [size.strip() for size in options.sizes.split(',')]
+    results = run_benchmarks(sizes, options.repeat)
+    report = open(options.output, 'w')
+    try:
+        json.dump({'timestamp': time.time(),
+                   'paragraphs_per_page': PARAGRAPHS_PER_PAGE,
+                   'sizes': dict((name, SIZES[name]) for name in sizes),
+                   'results': results}, report, indent=1, sort_keys=True)
+    finally:
+        report.close()
+
+if __name__ == '__main__':
+    main()
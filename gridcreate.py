@@ -1,8 +1,15 @@
 #!/usr/bin/python
 
+import cairo
+
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GObject
+from gi.repository import GLib
+
+# the grid grows by this number of cells, to not resize the palette on
+# every cell
+GROW_STEP = 3
 
 
 class GridCreateWidget(Gtk.DrawingArea):
@@ -19,6 +26,12 @@ class GridCreateWidget(Gtk.DrawingArea):
         self._columns = 0
         self._min_rows = 3
         self._min_columns = 3
+        self._min_col = self._min_columns
+        # the grid without the selected area, drawn once for every size
+        self._grid_surface = None
+        # rows and columns of the last motion, not yet displayed
+        self._pending = None
+        self._update_pending = False
 
         self._update_size()
         self.connect('draw', self.__draw_cb)
@@ -41,41 +54,97 @@ class GridCreateWidget(Gtk.DrawingArea):
                     Gdk.EventType.TOUCH_BEGIN,
                     Gdk.EventType.TOUCH_UPDATE, Gdk.EventType.BUTTON_PRESS,
                     Gdk.EventType.MOTION_NOTIFY):
-                # update rows and cols
+                # update rows and cols, once per frame
                 columns = int(x / self._cell_width) + 1
                 rows = int(y / self._cell_height) + 1
-                if self._columns != columns or self._rows != rows:
-                    self._columns = columns
-                    self._rows = rows
-                    self._update_size()
+                self._pending = (rows, columns)
+                self._queue_update()
 
             elif event.type in (Gdk.EventType.TOUCH_END,
                                 Gdk.EventType.BUTTON_RELEASE):
+                self._update()
                 self.emit('create-table', self._rows, self._columns)
 
+    def _queue_update(self):
+        if self._update_pending:
+            return
+        self._update_pending = True
+        if hasattr(self, 'add_tick_callback') and self.get_realized():
+            self.add_tick_callback(self.__update_tick_cb)
+        else:
+            # before gtk 3.8
+            GLib.idle_add(self.__update_idle_cb)
+
+    def __update_tick_cb(self, widget, frame_clock):
+        self._update()
+        return False
+
+    def __update_idle_cb(self):
+        self._update()
+        return False
+
+    def _update(self):
+        self._update_pending = False
+        if self._pending is None:
+            return
+        rows, columns = self._pending
+        self._pending = None
+        if self._columns == columns and self._rows == rows:
+            return
+
+        old_rows, old_columns = self._rows, self._columns
+        self._columns = columns
+        self._rows = rows
+        if self._columns + 1 > self._min_col or \
+                self._rows + 1 > self._min_rows:
+            self._update_size()
+            return
+
+        # redraw only the cells added or removed from the selection
+        max_height = max(rows, old_rows) * self._cell_height
+        max_width = max(columns, old_columns) * self._cell_width
+        x = min(columns, old_columns) * self._cell_width
+        self.queue_draw_area(x - 1, 0, max_width - x + 2, max_height + 1)
+        y = min(rows, old_rows) * self._cell_height
+        self.queue_draw_area(0, y - 1, max_width + 1, max_height - y + 2)
+
+    def _grow(self, cells, minimum):
+        if cells <= minimum:
+            return minimum
+        return (cells + GROW_STEP - 1) / GROW_STEP * GROW_STEP
+
     def _update_size(self):
-        self._min_col = max(self._columns + 1, self._min_columns)
+        self._min_col = self._grow(self._columns + 1, self._min_col)
         self._width = self._min_col * self._cell_width
-        self._min_rows = max(self._rows + 1, self._min_rows)
+        self._min_rows = self._grow(self._rows + 1, self._min_rows)
         self._height = self._min_rows * self._cell_height
+        self._grid_surface = None
         self.set_size_request(self._width, self._height)
         self.queue_draw()
 
+    def _get_grid_surface(self):
+        if self._grid_surface is None:
+            self._grid_surface = self.get_window().create_similar_surface(
+                cairo.CONTENT_COLOR, self._width, self._height)
+            cr = cairo.Context(self._grid_surface)
+            # background
+            cr.set_source_rgb(0.0, 0.0, 0.0)
+            cr.paint()
+            # draw grid
+            cr.set_source_rgb(1.0, 1.0, 1.0)
+            self._draw_grid(cr, self._min_rows, self._min_col, self._width,
+                            self._height)
+        return self._grid_surface
+
     def __draw_cb(self, widget, cr):
-        # background
-        cr.set_source_rgb(0.0, 0.0, 0.0)
-        cr.rectangle(0, 0, self._width, self._height)
-        cr.fill()
+        cr.set_source_surface(self._get_grid_surface(), 0, 0)
+        cr.paint()
         # used area
         cr.set_source_rgb(0.9, 0.9, 0.9)
         width = self._columns * self._cell_width
         height = self._rows * self._cell_height
         cr.rectangle(0, 0, width, height)
         cr.fill()
-        # draw grid
-        cr.set_source_rgb(1.0, 1.0, 1.0)
-        self._draw_grid(cr, self._min_rows, self._min_col, self._width,
-                        self._height)
         cr.set_source_rgb(0.0, 0.0, 0.0)
         self._draw_grid(cr, self._rows, self._columns, width, height)
 
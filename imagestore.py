@@ -0,0 +1,271 @@
+# Copyright (C) 2015 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+
+from gi.repository import GLib
+from gi.repository import GdkPixbuf
+
+logger = logging.getLogger('write-activity')
+
+# default maximum width or height in pixels of the inserted images
+MAX_IMAGE_SIZE = 1600
+
+JPEG_QUALITY = '85'
+
+# threads preparing images at the same time
+WORKERS = 4
+
+
+def run_in_thread(func, args, done_cb):
+    """
+    Run func(*args) in a worker thread, and then call
+    done_cb(result, error) in the main loop.
+    """
+    def worker():
+        result = None
+        error = None
+        try:
+            result = func(*args)
+        except Exception, e:
+            logger.exception('Error in worker thread')
+            error = e
+        GLib.idle_add(done_cb, result, error)
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+
+
+def run_all_in_threads(func, args_list, done_cb, workers=WORKERS):
+    """
+    Run func(*args) for every args in args_list, in up to workers
+    threads, and then call done_cb(results, errors) in the main loop,
+    with the results and errors in the order of args_list.
+    """
+    results = [None] * len(args_list)
+    errors = [None] * len(args_list)
+    pending = list(enumerate(args_list))
+    lock = threading.Lock()
+    running = [min(workers, len(args_list))]
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    running[0] -= 1
+                    if running[0] == 0:
+                        GLib.idle_add(done_cb, results, errors)
+                    return
+                index, args = pending.pop(0)
+            try:
+                results[index] = func(*args)
+            except Exception, e:
+                logger.exception('Error in worker thread')
+                errors[index] = e
+
+    if not args_list:
+        GLib.idle_add(done_cb, results, errors)
+        return
+    for i in range(running[0]):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+
+
+def _encode(pixbuf, file_format):
+    """
+    Encode photos as jpeg and graphics as png. An image without
+    transparency is considered a photo if it was a jpeg, or if the png
+    needs more than a byte per pixel.
+    """
+    if file_format != 'jpeg' or pixbuf.get_has_alpha():
+        success, data = pixbuf.save_to_bufferv('png', [], [])
+        if pixbuf.get_has_alpha() or \
+                len(data) <= pixbuf.get_width() * pixbuf.get_height():
+            return data, '.png'
+    success, data = pixbuf.save_to_bufferv('jpeg', ['quality'],
+                                           [JPEG_QUALITY])
+    return data, '.jpg'
+
+
+class ImageStore(object):
+    """
+    Content addressed store of the images prepared to be inserted, so
+    the same image is not encoded and written again, and register of the
+    temporary files written in the instance directory.
+
+    The instance directory is shared by all the Write instances, every
+    process uses its own subdirectory, removed by close().
+    """
+
+    def __init__(self, instance_dir):
+        self._instance_dir = instance_dir
+        self.directory = os.path.join(instance_dir,
+                                      'images-%d' % os.getpid())
+        self._temporaries = set()
+        self._lock = threading.Lock()
+        self._remove_stale_directories()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def _remove_stale_directories(self):
+        # directories of Write instances not running anymore
+        for name in os.listdir(self._instance_dir):
+            if not name.startswith('images-'):
+                continue
+            try:
+                pid = int(name[len('images-'):])
+                os.kill(pid, 0)
+            except ValueError:
+                continue
+            except OSError:
+                logger.debug('Removing stale image store %s', name)
+                shutil.rmtree(os.path.join(self._instance_dir, name),
+                              ignore_errors=True)
+
+    def lookup(self, key):
+        for suffix in ('.png', '.jpg'):
+            file_path = os.path.join(self.directory, key + suffix)
+            if os.path.exists(file_path):
+                return file_path
+        return None
+
+    def add(self, key, data, suffix):
+        file_path = os.path.join(self.directory, key + suffix)
+        # write and rename, a concurrent lookup never sees a partial file
+        temp_path = self.create_temporary(data, suffix)
+        os.rename(temp_path, file_path)
+        self.discard_temporary(temp_path)
+        return file_path
+
+    def create_temporary(self, data, suffix):
+        """Write data in a temporary file removed by collect()"""
+        fd, file_path = tempfile.mkstemp(dir=self.directory, suffix=suffix)
+        os.write(fd, data)
+        os.close(fd)
+        with self._lock:
+            self._temporaries.add(file_path)
+        return file_path
+
+    def add_temporary(self, file_path):
+        with self._lock:
+            self._temporaries.add(file_path)
+
+    def discard_temporary(self, file_path):
+        with self._lock:
+            self._temporaries.discard(file_path)
+
+    def collect(self):
+        """Remove the temporary files still in the instance directory"""
+        with self._lock:
+            temporaries = self._temporaries
+            self._temporaries = set()
+        for file_path in temporaries:
+            if os.path.exists(file_path):
+                logger.debug('Removing temporary file %s', file_path)
+                os.remove(file_path)
+
+    def close(self):
+        self.collect()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _get_key(source, max_size):
+    digest = hashlib.sha1()
+    if isinstance(source, GdkPixbuf.Pixbuf):
+        digest.update('%d %d %d' % (source.get_width(), source.get_height(),
+                                    source.get_rowstride()))
+        digest.update(source.get_pixels())
+    else:
+        source_file = open(source)
+        try:
+            for block in iter(lambda: source_file.read(65536), ''):
+                digest.update(block)
+        finally:
+            source_file.close()
+    return '%s-%d' % (digest.hexdigest(), max_size)
+
+
+def prepare_image(source, store, max_size, keep_original=False):
+    """
+    Downscale and recompress an image to be inserted in the document,
+    source is a file path or a pixbuf. Can run in a worker thread.
+
+    Return a dictionary with the 'file_path' to insert, the size in
+    'original_bytes' and 'bytes', and if keep_original is True and the
+    image was changed, the 'original_path' of the image as png if
+    source was a pixbuf, or None.
+    """
+    result = {'original_path': None}
+    if isinstance(source, GdkPixbuf.Pixbuf):
+        file_format = None
+        width = source.get_width()
+        height = source.get_height()
+        result['original_bytes'] = source.get_byte_length()
+    else:
+        file_info, width, height = GdkPixbuf.Pixbuf.get_file_info(source)
+        result['original_bytes'] = os.path.getsize(source)
+        if file_info is None or width == 0 or height == 0:
+            # not known by gdk-pixbuf, let libabiword try
+            result['file_path'] = source
+            result['bytes'] = result['original_bytes']
+            return result
+        file_format = file_info.get_name()
+
+    scale = min(1.0, float(max_size) / max(width, height))
+    if scale == 1.0 and file_format in ('jpeg', 'png'):
+        # nothing to gain
+        result['file_path'] = source
+        result['bytes'] = result['original_bytes']
+        return result
+
+    key = _get_key(source, max_size)
+    file_path = store.lookup(key)
+    if file_path is not None:
+        # the same image was already inserted
+        result['file_path'] = file_path
+        result['bytes'] = os.path.getsize(file_path)
+        return result
+
+    if file_format is None:
+        pixbuf = source
+    else:
+        pixbuf = GdkPixbuf.Pixbuf.new_from_file(source)
+        pixbuf = pixbuf.apply_embedded_orientation()
+        # rotated photos swap the width and the height
+        width = pixbuf.get_width()
+        height = pixbuf.get_height()
+    if scale < 1.0:
+        pixbuf = pixbuf.scale_simple(max(1, int(width * scale)),
+                                     max(1, int(height * scale)),
+                                     GdkPixbuf.InterpType.BILINEAR)
+    data, suffix = _encode(pixbuf, file_format)
+    result['file_path'] = store.add(key, data, suffix)
+    result['bytes'] = len(data)
+
+    if keep_original and file_format is None and scale < 1.0:
+        success, data = source.save_to_bufferv('png', [], [])
+        result['original_path'] = store.create_temporary(data, '.png')
+    logger.debug('Image prepared %dx%d -> %dx%d, %d -> %d bytes', width,
+                 height, pixbuf.get_width(), pixbuf.get_height(),
+                 result['original_bytes'], result['bytes'])
+    return result
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Record and replay of editing sessions.
+
+When the WRITE_RECORD_SESSION environment variable is set to a file
+path, AbiWordActivity records there the key events received by the
+document and the calls the toolbars do to the abiword canvas (style
+changes, zoom, page, search, paste...), one json object per line. The
+images inserted are copied to a directory next to the file, named as
+the file with an -images suffix.
+
+Running this module replays a recorded session against a document, as
+fast as possible, and reports the latency percentiles of every action:
+
+    xvfb-run python inputsession.py session.jsonl document.odt \\
+        --output latency.json
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import logging
+from optparse import OptionParser
+
+from gi.repository import Gtk
+from gi.repository import Gdk
+
+RECORD_SESSION_ENV = 'WRITE_RECORD_SESSION'
+
+# the abiword canvas methods called from the toolbars
+RECORDED_METHODS = ['toggle_bold', 'toggle_italic', 'toggle_underline',
+                    'set_style', 'set_font_name', 'set_font_size',
+                    'set_text_color', 'align_left', 'align_center',
+                    'align_right', 'align_justify', 'set_zoom_percentage',
+                    'zoom_width', 'set_current_page', 'set_find_string',
+                    'find_next', 'find_prev', 'copy', 'paste', 'undo',
+                    'redo', 'insert_table', 'insert_image', 'invoke_ex',
+                    'select_occurrence', 'replace_all', 'insert_images',
+                    'invoke_repeated', 'insert_table_with_data',
+                    'select_in_paragraph', 'select_next_occurrence']
+
+# the methods inserting image files, the files are copied next to the
+# session, the image store of the activity is removed when it closes
+IMAGE_METHODS = ['insert_image', 'insert_images']
+
+_PATTERN_TYPE = type(re.compile(''))
+
+logger = logging.getLogger('write-activity')
+
+
+class SessionRecorder(object):
+
+    def __init__(self, abiword_canvas, file_path):
+        self._canvas = abiword_canvas
+        self._file = open(file_path, 'w')
+        self._start = time.time()
+        self._depth = 0
+        self._images_dir = file_path + '-images'
+        self._image_count = 0
+
+        for name in RECORDED_METHODS:
+            setattr(abiword_canvas, name,
+                    self._wrap(name, getattr(abiword_canvas, name)))
+        abiword_canvas.connect('key-press-event', self.__key_event_cb)
+        abiword_canvas.connect('key-release-event', self.__key_event_cb)
+        logger.debug('Recording session in %s', file_path)
+
+    def _write(self, record):
+        record['time'] = time.time() - self._start
+        self._file.write(json.dumps(record, default=_encode_arg) + '\n')
+        self._file.flush()
+
+    def _wrap(self, name, method):
+        def wrapper(*args):
+            # only record the calls done from the toolbars, not the
+            # ones done by other recorded methods
+            if self._depth == 0:
+                record_args = list(args)
+                if name in IMAGE_METHODS:
+                    record_args[0] = self._copy_images(record_args[0])
+                self._write({'type': 'call', 'method': name,
+                             'args': record_args})
+            self._depth += 1
+            try:
+                return method(*args)
+            finally:
+                self._depth -= 1
+        return wrapper
+
+    def _copy_images(self, file_paths):
+        """
+        Copy the image files, a path or a list of paths, next to the
+        session, return their paths relative to the session directory.
+        """
+        if isinstance(file_paths, list):
+            return [self._copy_images(file_path) for file_path in
+                    file_paths]
+        if not os.path.exists(self._images_dir):
+            os.makedirs(self._images_dir)
+        self._image_count += 1
+        name = '%d-%s' % (self._image_count, os.path.basename(file_paths))
+        try:
+            shutil.copy(file_paths, os.path.join(self._images_dir, name))
+        except (IOError, OSError), e:
+            logger.error('Can not copy the image %s: %s', file_paths, e)
+        return os.path.join(os.path.basename(self._images_dir), name)
+
+    def __key_event_cb(self, widget, event):
+        self._write({'type': 'key',
+                     'release': event.type == Gdk.EventType.KEY_RELEASE,
+                     'keyval': event.keyval,
+                     'state': int(event.state),
+                     'keycode': event.hardware_keycode})
+        return False
+
+    def close(self):
+        self._file.close()
+
+
+def _encode_arg(arg):
+    # the compiled patterns passed to replace_all
+    if isinstance(arg, _PATTERN_TYPE):
+        return {'pattern': arg.pattern, 'flags': arg.flags}
+    raise TypeError('%r can not be recorded' % arg)
+
+
+def _decode_arg(arg):
+    if isinstance(arg, dict) and 'pattern' in arg:
+        return re.compile(arg['pattern'], arg['flags'])
+    if isinstance(arg, list):
+        return [_decode_arg(item) for item in arg]
+    if isinstance(arg, unicode):
+        # the canvas methods expect utf-8 strings
+        return arg.encode('utf-8')
+    return arg
+
+
+def load_session(file_path):
+    session = open(file_path)
+    try:
+        records = [json.loads(line) for line in session if line.strip()]
+    finally:
+        session.close()
+
+    # the image paths are relative to the session directory
+    directory = os.path.dirname(os.path.abspath(file_path))
+    for record in records:
+        if record['type'] == 'call' and record['method'] in IMAGE_METHODS:
+            paths = record['args'][0]
+            if isinstance(paths, list):
+                record['args'][0] = [os.path.join(directory, path) for path
+                                     in paths]
+            else:
+                record['args'][0] = os.path.join(directory, paths)
+    return records
+
+
+def _flush_events():
+    while Gtk.events_pending():
+        Gtk.main_iteration()
+
+
+def _action_name(record):
+    if record['type'] == 'call':
+        return record['method']
+    if Gdk.keyval_to_unicode(record['keyval']):
+        return 'key:char'
+    return 'key:%s' % Gdk.keyval_name(record['keyval'])
+
+
+def _send_key(canvas, record):
+    if record['release']:
+        event = Gdk.Event.new(Gdk.EventType.KEY_RELEASE)
+    else:
+        event = Gdk.Event.new(Gdk.EventType.KEY_PRESS)
+    event.key.window = canvas.get_window()
+    event.key.keyval = record['keyval']
+    event.key.state = Gdk.ModifierType(record['state'])
+    event.key.hardware_keycode = record['keycode']
+    event.key.time = Gdk.CURRENT_TIME
+    canvas.event(event)
+
+
+def percentiles(times):
+    times = sorted(times)
+    count = len(times)
+
+    def percentile(p):
+        return times[min(count - 1, int(count * p / 100.0))] * 1000
+
+    return {'count': count,
+            'mean_ms': sum(times) / count * 1000,
+            'p50_ms': percentile(50),
+            'p90_ms': percentile(90),
+            'p99_ms': percentile(99),
+            'max_ms': times[-1] * 1000}
+
+
+def replay(records, document_path, realtime=False):
+    from widgets import DocumentView
+
+    window = Gtk.OffscreenWindow()
+    canvas = DocumentView()
+    window.add(canvas)
+    window.set_default_size(1024, 768)
+    window.show_all()
+    _flush_events()
+
+    canvas.invoke_ex('com.abisource.abiword.loadbindings.fromURI',
+                     os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'keybindings.xml'), 0, 0)
+    canvas.load_file('file://' + os.path.abspath(document_path), '')
+    canvas.grab_focus()
+    _flush_events()
+
+    latencies = {}
+    start = time.time()
+    for record in records:
+        if realtime:
+            # keep the pauses of the recorded session
+            while time.time() - start < record['time']:
+                _flush_events()
+                time.sleep(0.001)
+
+        action_start = time.time()
+        if record['type'] == 'key':
+            _send_key(canvas, record)
+        else:
+            getattr(canvas, record['method'])(
+                *[_decode_arg(arg) for arg in record['args']])
+        # include the layout and paint caused by the action
+        _flush_events()
+        if record['type'] == 'key' and record['release']:
+            continue
+        latencies.setdefault(_action_name(record), []).append(
+            time.time() - action_start)
+
+    window.destroy()
+    return dict((name, percentiles(times)) for name, times in
+                latencies.iteritems())
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] session document')
+    parser.add_option('--output', help='write the results as json to a file')
+    parser.add_option('--realtime', action='store_true', default=False,
+                      help='keep the timing of the recorded session')
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('a session and a document are needed')
+
+    results = replay(load_session(args[0]), args[1], options.realtime)
+    for name in sorted(results):
+        sys.stdout.write('%-24s %6d  p50 %8.2f ms  p90 %8.2f ms  '
+                         'p99 %8.2f ms\n' % (
+                             name, results[name]['count'],
+                             results[name]['p50_ms'], results[name]['p90_ms'],
+                             results[name]['p99_ms']))
+
+    if options.output:
+        report = open(options.output, 'w')
+        try:
+            json.dump({'timestamp': time.time(), 'session': args[0],
+                       'document': args[1], 'results': results},
+                      report, indent=1, sort_keys=True)
+        finally:
+            report.close()
+
+if __name__ == '__main__':
+    main()
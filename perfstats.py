@@ -0,0 +1,149 @@
+# Copyright (C) 2015 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import os
+import json
+import time
+import functools
+
+# environment variable to enable the paint statistics in the DocumentView,
+# set it to 'overlay' to also display them over the document
+PAINT_STATS_ENV = 'WRITE_PAINT_STATS'
+
+# environment variable to enable the timing of the toolbar actions
+ACTION_STATS_ENV = 'WRITE_ACTION_STATS'
+
+# number of calls kept in the action stats ring buffer
+_RING_SIZE = 1024
+
+# bucket n counts the durations between 2 ** (n - 1) and 2 ** n ms
+_BUCKETS = 16
+
+
+class Histogram(object):
+    """Histogram of durations in milliseconds, with power of two buckets"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.buckets = [0] * _BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        bucket = 0
+        limit = 1
+        while duration > limit and bucket < _BUCKETS - 1:
+            bucket += 1
+            limit *= 2
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def percentile(self, percent):
+        """Return the upper limit of the bucket containing the percentile"""
+        if self.count == 0:
+            return 0
+        target = self.count * percent / 100.0
+        accumulated = 0
+        for bucket, count in enumerate(self.buckets):
+            accumulated += count
+            if accumulated >= target:
+                return min(2 ** bucket, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'mean_ms': self.total / self.count if self.count else 0,
+                'max_ms': self.max,
+                'p50_ms': self.percentile(50),
+                'p95_ms': self.percentile(95),
+                'buckets_ms': dict(('<=%d' % 2 ** n, count) for n, count in
+                                   enumerate(self.buckets) if count)}
+
+
+class ActionStats(object):
+    """
+    Call counts and latency histograms by action name, and the last calls
+    in a ring buffer.
+    """
+
+    def __init__(self, size=_RING_SIZE):
+        self._ring = [None] * size
+        self._next = 0
+        self.histograms = {}
+
+    def add(self, name, start, duration):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.add(duration)
+        self._ring[self._next] = (start, name, duration)
+        self._next = (self._next + 1) % len(self._ring)
+
+    def get_recent(self):
+        ring = self._ring[self._next:] + self._ring[:self._next]
+        return [{'time': entry[0], 'action': entry[1], 'duration_ms': entry[2]}
+                for entry in ring if entry is not None]
+
+    def to_dict(self):
+        return {'actions': dict((name, histogram.to_dict()) for
+                                name, histogram in self.histograms.items()),
+                'recent': self.get_recent()}
+
+
+action_stats = None
+if os.environ.get(ACTION_STATS_ENV):
+    action_stats = ActionStats()
+
+
+def timed(name, detail=None):
+    """
+    Decorator recording the duration of every call in action_stats, under
+    the given name. detail is an optional function receiving the same
+    arguments than the decorated one, returning a string to be appended
+    to the name, to distinguish the actions done by a shared callback.
+    When the action stats are not enabled the function is not wrapped.
+    """
+    def decorator(func):
+        if action_stats is None:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                duration = (time.time() - start) * 1000
+                if detail is None:
+                    action_stats.add(name, start, duration)
+                else:
+                    action_stats.add('%s:%s' % (name, detail(*args)), start,
+                                     duration)
+        return wrapper
+    return decorator
+
+
+def dump(file_path, stats):
+    stats_file = open(file_path, 'w')
+    try:
+        json.dump(stats, stats_file, indent=1, sort_keys=True)
+    finally:
+        stats_file.close()
@@ -0,0 +1,44 @@
+# Copyright (C) 2015 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import csv
+from cStringIO import StringIO
+
+# separators tried when the text is not tab separated
+CSV_DELIMITERS = ',;'
+
+
+def parse_table_text(text):
+    """
+    Split CSV text, or tab separated text as copied from a spreadsheet,
+    in rows of cells. All the rows have the same number of cells.
+    """
+    text = text.strip('\r\n')
+    if not text:
+        return []
+    first_line = text.splitlines()[0]
+    if '\t' in first_line:
+        delimiter = '\t'
+    else:
+        try:
+            delimiter = csv.Sniffer().sniff(first_line,
+                                            CSV_DELIMITERS).delimiter
+        except csv.Error:
+            delimiter = ','
+    rows = list(csv.reader(StringIO(text), delimiter=delimiter))
+    columns = max(len(row) for row in rows)
+    return [row + [''] * (columns - len(row)) for row in rows]
+
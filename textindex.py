@@ -0,0 +1,350 @@
+# Copyright (C) 2015 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import re
+from gettext import gettext as _
+from xml.sax.saxutils import unescape
+
+from gi.repository import GObject
+
+
+_ABW_TAG_RE = re.compile(r'(<[^>]*>)')
+_ABW_PARAGRAPH_RE = re.compile(r'<p(?:\s[^>]*)?(?:/>|>.*?</p>)', re.DOTALL)
+_ABW_STYLE_RE = re.compile(r'\sstyle="([^"]*)"')
+
+# paragraph styles listed in the outline, and their level
+HEADING_STYLES = {'Heading 1': 1, 'Heading 2': 2, 'Heading 3': 3,
+                  'Heading 4': 4}
+
+
+def compile_query(query, regex=False, whole_word=False, match_case=False):
+    """Compile a search, raise re.error if the expression is not valid"""
+    query = query.decode('utf-8')
+    pattern = query if regex else re.escape(query)
+    if whole_word:
+        pattern = r'\b(?:%s)\b' % pattern
+    flags = re.UNICODE
+    if not match_case:
+        flags |= re.IGNORECASE
+    return re.compile(pattern, flags)
+
+
+def _diff(old, new):
+    """
+    Compare two lists, return (first, old_end, new_end) such that
+    replacing old[first:old_end] by new[first:new_end] changes old in new.
+    """
+    first = 0
+    limit = min(len(old), len(new))
+    while first < limit and old[first] == new[first]:
+        first += 1
+    old_end = len(old)
+    new_end = len(new)
+    while old_end > first and new_end > first and \
+            old[old_end - 1] == new[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+    return first, old_end, new_end
+
+
+class TextSnapshot(GObject.GObject):
+    """
+    Plain text of the document, split in paragraphs.
+
+    Every update compares the new text with the previous one and emits
+    'changed' with the range of paragraphs replaced, paragraphs
+    [first:old_end] by the new paragraphs [first:new_end], so the
+    indexes built over the snapshot only process the changed paragraphs.
+    """
+
+    __gsignals__ = {
+        'changed': (GObject.SignalFlags.RUN_FIRST, None, [int, int, int]), }
+
+    def __init__(self):
+        GObject.GObject.__init__(self)
+        self.revision = None
+        self.paragraphs = []
+        self._offsets = None
+        self._folded_text = None
+
+    def update(self, text, revision):
+        self.revision = revision
+        paragraphs = text.decode('utf-8').split('\n')
+        first, old_end, new_end = _diff(self.paragraphs, paragraphs)
+        self.paragraphs = paragraphs
+        if first == old_end and first == new_end:
+            return
+        self._offsets = None
+        self._folded_text = None
+        self.emit('changed', first, old_end, new_end)
+
+    def get_offset(self, paragraph):
+        """Offset of the paragraph start in the text"""
+        if self._offsets is None:
+            self._offsets = []
+            offset = 0
+            for text in self.paragraphs:
+                self._offsets.append(offset)
+                offset += len(text) + 1
+        return self._offsets[paragraph]
+
+    def get_folded_text(self):
+        """Lower case text, as used by the libabiword search"""
+        if self._folded_text is None:
+            self._folded_text = '\n'.join(self.paragraphs).lower()
+        return self._folded_text
+
+
+def plan_replacements(snapshot, pattern, replacement, regex=False):
+    """
+    Map the matches of pattern in a TextSnapshot to the libabiword
+    searches that select them in order from the beginning of the
+    document. Return a list of (text, skipped, new_text): the text
+    matched, the occurrences of it to skip from the end of the previous
+    match, as seen by the case insensitive libabiword search, and the
+    text replacing it. If regex is True, replacement can reference the
+    groups of the pattern, raise re.error if a group is not valid.
+    """
+    replacement = replacement.decode('utf-8')
+    folded_text = snapshot.get_folded_text()
+    replacements = []
+    position = 0
+    for paragraph, text in enumerate(snapshot.paragraphs):
+        offset = snapshot.get_offset(paragraph)
+        for match in pattern.finditer(text):
+            if match.end() == match.start():
+                continue
+            matched = match.group()
+            start = offset + match.start()
+            # the occurrences before the match, and the ones overlapping
+            # its beginning, are found first
+            skipped = folded_text.count(matched.lower(), position,
+                                        start + len(matched) - 1)
+            new_text = match.expand(replacement) if regex else replacement
+            replacements.append((matched.encode('utf-8'), skipped,
+                                 new_text.encode('utf-8')))
+            position = offset + match.end()
+    return replacements
+
+
+class SearchIndex(object):
+    """
+    Matches of a search in a TextSnapshot.
+
+    The query can be a regular expression, and be restricted to whole
+    words or exact case. The matches are updated when the snapshot
+    changes, searching again only in the changed paragraphs. Keeps the
+    position of the match selected in the document, if known.
+    """
+
+    def __init__(self, snapshot, query, regex=False, whole_word=False,
+                 match_case=False):
+        self._pattern = compile_query(query, regex, whole_word, match_case)
+        self.query = query
+        self.current = None
+        self._snapshot = snapshot
+        self._matches = None
+        self._paragraph_matches = [self._search(text) for text in
+                                   snapshot.paragraphs]
+        self._changed_id = snapshot.connect('changed', self.__changed_cb)
+
+    def _search(self, text):
+        return [(match.start(), match.end()) for match in
+                self._pattern.finditer(text) if match.end() > match.start()]
+
+    def __changed_cb(self, snapshot, first, old_end, new_end):
+        self._paragraph_matches[first:old_end] = [
+            self._search(text) for text in snapshot.paragraphs[first:new_end]]
+        self._matches = None
+        # the document changed, the selected match is unknown
+        self.current = None
+
+    def destroy(self):
+        self._snapshot.disconnect(self._changed_id)
+
+    def get_matches(self):
+        """List of (paragraph, start, end) of every match"""
+        if self._matches is None:
+            self._matches = []
+            for paragraph, matches in enumerate(self._paragraph_matches):
+                for start, end in matches:
+                    self._matches.append((paragraph, start, end))
+        return self._matches
+
+    def __len__(self):
+        return len(self.get_matches())
+
+    def get_target(self, index):
+        """
+        Map a match to something libabiword can select: the text matched,
+        the number of occurrences of this text before it and in the whole
+        document, as seen by the case insensitive libabiword search.
+        """
+        paragraph, start, end = self.get_matches()[index]
+        text = self._snapshot.paragraphs[paragraph][start:end]
+        offset = self._snapshot.get_offset(paragraph) + start
+        folded_text = self._snapshot.get_folded_text()
+        occurrence = folded_text.count(text.lower(), 0, offset)
+        total = folded_text.count(text.lower())
+        return text.encode('utf-8'), occurrence, total
+
+    def find_match(self, offset):
+        """
+        Index of the first match starting at or after offset in the text,
+        or None if there are none.
+        """
+        for index, (paragraph, start, end) in enumerate(self.get_matches()):
+            if self._snapshot.get_offset(paragraph) + start >= offset:
+                return index
+        return None
+
+    def get_skipped(self, index, offset):
+        """
+        Number of occurrences of the text of a match the case insensitive
+        libabiword search finds searching from offset, before the match.
+        """
+        paragraph, start, end = self.get_matches()[index]
+        text = self._snapshot.paragraphs[paragraph][start:end].lower()
+        match_offset = self._snapshot.get_offset(paragraph) + start
+        return self._snapshot.get_folded_text().count(
+            text, offset, match_offset + len(text) - 1)
+
+    def get_label(self):
+        count = len(self)
+        if count == 0:
+            return _('No matches')
+        if self.current is None:
+            return _('%d matches') % count
+        return _('%(current)d of %(total)d') % {
+            'current': self.current + 1, 'total': count}
+
+
+class OutlineIndex(GObject.GObject):
+    """
+    Headings of an AbiWord document.
+
+    Every update compares the paragraphs of the new document with the
+    previous ones, and only the changed paragraphs are parsed again.
+    Emits 'changed' with the range of headings replaced, headings
+    [first:old_end] by the new headings [first:new_end].
+    """
+
+    __gsignals__ = {
+        'changed': (GObject.SignalFlags.RUN_FIRST, None, [int, int, int]), }
+
+    def __init__(self):
+        GObject.GObject.__init__(self)
+        self.revision = None
+        self._raw_paragraphs = []
+        # (level, text) of every paragraph, level is 0 if not a heading
+        self._paragraphs = []
+        # (paragraph, level, text) of every heading
+        self.headings = []
+
+    def _parse(self, raw_paragraph):
+        tag_end = raw_paragraph.index('>')
+        match = _ABW_STYLE_RE.search(raw_paragraph, 0, tag_end)
+        level = HEADING_STYLES.get(match.group(1), 0) if match else 0
+        text = unescape(_ABW_TAG_RE.sub('', raw_paragraph[tag_end + 1:]))
+        return level, text.decode('utf-8')
+
+    def _find_heading(self, paragraph):
+        # index of the first heading at or after the paragraph
+        low = 0
+        high = len(self.headings)
+        while low < high:
+            middle = (low + high) // 2
+            if self.headings[middle][0] < paragraph:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def update(self, content, revision):
+        self.revision = revision
+        raw_paragraphs = _ABW_PARAGRAPH_RE.findall(content)
+        first, old_end, new_end = _diff(self._raw_paragraphs, raw_paragraphs)
+        self._raw_paragraphs = raw_paragraphs
+        if first == old_end and first == new_end:
+            return
+
+        paragraphs = [self._parse(raw_paragraph) for raw_paragraph in
+                      raw_paragraphs[first:new_end]]
+        self._paragraphs[first:old_end] = paragraphs
+
+        first_heading = self._find_heading(first)
+        old_end_heading = self._find_heading(old_end)
+        headings = [(first + i, level, text) for i, (level, text) in
+                    enumerate(paragraphs) if level > 0 and text.strip()]
+        delta = new_end - old_end
+        if delta != 0:
+            for i in range(old_end_heading, len(self.headings)):
+                paragraph, level, text = self.headings[i]
+                self.headings[i] = (paragraph + delta, level, text)
+        self.headings[first_heading:old_end_heading] = headings
+        if old_end_heading > first_heading or headings:
+            self.emit('changed', first_heading, old_end_heading,
+                      first_heading + len(headings))
+
+    def get_target(self, index):
+        """
+        Map a heading to something libabiword can select: the heading
+        text, the number of occurrences of this text before it and in the
+        whole document, as seen by the case insensitive libabiword search.
+        """
+        paragraph, level, text = self.headings[index]
+        folded = text.lower()
+        occurrence = 0
+        total = 0
+        for i, (level, paragraph_text) in enumerate(self._paragraphs):
+            count = paragraph_text.lower().count(folded)
+            if i < paragraph:
+                occurrence += count
+            total += count
+        return text.encode('utf-8'), occurrence, total
+
+
+class TextStatistics(object):
+    """
+    Word and character counts of a TextSnapshot, updated when the
+    snapshot changes by counting again only the changed paragraphs.
+    """
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        # (words, characters) of every paragraph
+        self._counts = [self._count(text) for text in snapshot.paragraphs]
+        self.words = sum(words for words, characters in self._counts)
+        self.characters = sum(characters for words, characters in
+                              self._counts)
+        self._changed_id = snapshot.connect('changed', self.__changed_cb)
+
+    def _count(self, text):
+        return len(text.split()), len(text)
+
+    def __changed_cb(self, snapshot, first, old_end, new_end):
+        for words, characters in self._counts[first:old_end]:
+            self.words -= words
+            self.characters -= characters
+        counts = [self._count(text) for text in
+                  snapshot.paragraphs[first:new_end]]
+        for words, characters in counts:
+            self.words += words
+            self.characters += characters
+        self._counts[first:old_end] = counts
+
+    def destroy(self):
+        self._snapshot.disconnect(self._changed_id)
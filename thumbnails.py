@@ -0,0 +1,247 @@
+# Copyright (C) 2015 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+import logging
+from collections import OrderedDict
+
+from gi.repository import GLib
+from gi.repository import Gtk
+from gi.repository import GdkPixbuf
+
+from sugar3.graphics import style
+
+logger = logging.getLogger('write-activity')
+
+# memory used by the cached thumbnails
+MAX_THUMBNAILS_BYTES = 8 * 1024 * 1024
+
+THUMBNAIL_WIDTH = style.GRID_CELL_SIZE * 2
+
+# ms between the checks for changes in the document, while visible
+CHECK_DELAY = 1000
+
+
+class ThumbnailCache(object):
+    """
+    Least recently used pixbufs, up to a total size in bytes. If set,
+    evicted_cb(key) is called for every pixbuf removed.
+    """
+
+    def __init__(self, max_bytes=MAX_THUMBNAILS_BYTES, evicted_cb=None):
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._pixbufs = OrderedDict()
+        self._evicted_cb = evicted_cb
+
+    def _get_size(self, pixbuf):
+        return pixbuf.get_rowstride() * pixbuf.get_height()
+
+    def get(self, key):
+        pixbuf = self._pixbufs.pop(key, None)
+        if pixbuf is not None:
+            self._pixbufs[key] = pixbuf
+        return pixbuf
+
+    def add(self, key, pixbuf):
+        old_pixbuf = self._pixbufs.pop(key, None)
+        if old_pixbuf is not None:
+            self._bytes -= self._get_size(old_pixbuf)
+        self._pixbufs[key] = pixbuf
+        self._bytes += self._get_size(pixbuf)
+        while self._bytes > self._max_bytes and len(self._pixbufs) > 1:
+            key, old_pixbuf = self._pixbufs.popitem(last=False)
+            self._bytes -= self._get_size(old_pixbuf)
+            if self._evicted_cb is not None:
+                self._evicted_cb(key)
+
+    def clear(self):
+        keys = self._pixbufs.keys()
+        self._pixbufs.clear()
+        self._bytes = 0
+        if self._evicted_cb is not None:
+            for key in keys:
+                self._evicted_cb(key)
+
+
+class PageThumbnailPanel(Gtk.ScrolledWindow):
+    """
+    Thumbnails of the pages of the document, activating one moves to
+    the page.
+
+    The thumbnails are rendered in idle time, only for the visible
+    pages, and cached by page and revision of the page. An edit only
+    invalidates the current page, and the following ones if the number
+    of pages changed.
+    """
+
+    def __init__(self, document_view):
+        Gtk.ScrolledWindow.__init__(self)
+        self._document_view = document_view
+        self._cache = ThumbnailCache(evicted_cb=self.__evicted_cb)
+        # key of the thumbnail shown by every page, the pixbufs in the
+        # store are replaced when evicted from the cache
+        self._shown_keys = {}
+        # every invalidation increments the generation of the pages, used
+        # with the page number as key of the cached thumbnails
+        self._generation = 0
+        self._page_generations = {}
+        self._revision = document_view.get_revision()
+        self._load_revision = document_view.get_load_revision()
+        self._current_page = 1
+        self._timeout_id = None
+        self._render_id = None
+
+        self.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        self.set_size_request(THUMBNAIL_WIDTH + style.GRID_CELL_SIZE, -1)
+
+        # page number, thumbnail and if it is up to date
+        self._store = Gtk.ListStore(str, GdkPixbuf.Pixbuf, bool)
+        self._icon_view = Gtk.IconView(model=self._store)
+        self._icon_view.set_pixbuf_column(1)
+        self._icon_view.set_text_column(0)
+        self._icon_view.set_columns(1)
+        self._icon_view.set_item_width(THUMBNAIL_WIDTH)
+        self._icon_view.connect('item-activated', self.__item_activated_cb)
+        if hasattr(self._icon_view, 'set_activate_on_single_click'):
+            # since gtk 3.8
+            self._icon_view.set_activate_on_single_click(True)
+        self._icon_view.show()
+        self.add(self._icon_view)
+
+        self._placeholder = GdkPixbuf.Pixbuf.new(
+            GdkPixbuf.Colorspace.RGB, False, 8, THUMBNAIL_WIDTH,
+            THUMBNAIL_WIDTH * 297 / 210)
+        self._placeholder.fill(0xffffffff)
+
+        document_view.connect('page-count', self.__page_count_cb)
+        document_view.connect('current-page', self.__current_page_cb)
+        self.get_vadjustment().connect('value-changed',
+                                       self.__scrolled_cb)
+        self.connect('map', self.__map_cb)
+        self.connect('unmap', self.__unmap_cb)
+
+    def __map_cb(self, widget):
+        self._check_revision()
+        self._queue_render()
+        self._timeout_id = GLib.timeout_add(CHECK_DELAY,
+                                            self.__check_timeout_cb)
+
+    def __unmap_cb(self, widget):
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
+        if self._render_id is not None:
+            GLib.source_remove(self._render_id)
+            self._render_id = None
+
+    def __check_timeout_cb(self):
+        self._check_revision()
+        return True
+
+    def _check_revision(self):
+        # attribute the edits done since the last check to the current page
+        revision = self._document_view.get_revision()
+        if revision == self._revision:
+            return
+        self._revision = revision
+        load_revision = self._document_view.get_load_revision()
+        if load_revision != self._load_revision:
+            # other document, or the same one reloaded
+            self._load_revision = load_revision
+            self._cache.clear()
+            self._invalidate(1, len(self._store))
+        else:
+            self._invalidate(self._current_page, self._current_page)
+
+    def _invalidate(self, first_page, last_page):
+        self._generation += 1
+        for page in range(first_page, last_page + 1):
+            self._page_generations[page] = self._generation
+            if page <= len(self._store):
+                self._store[page - 1][2] = False
+        self._queue_render()
+
+    def _get_key(self, page):
+        return page, self._page_generations.get(page, 0)
+
+    def __page_count_cb(self, document_view, count):
+        old_count = len(self._store)
+        if count == old_count:
+            return
+        while len(self._store) > count:
+            self._shown_keys.pop(len(self._store), None)
+            self._store.remove(self._store.get_iter(len(self._store) - 1))
+        for page in range(old_count + 1, count + 1):
+            self._store.append([str(page), self._placeholder, False])
+        # the text after the edit moved to other pages
+        self._check_revision()
+        self._invalidate(min(self._current_page, count + 1), count)
+
+    def __current_page_cb(self, document_view, page):
+        # the edits until now were in the previous page
+        self._check_revision()
+        self._current_page = page
+
+    def __scrolled_cb(self, adjustment):
+        self._queue_render()
+
+    def _queue_render(self):
+        if self._render_id is None and self.get_mapped():
+            self._render_id = GLib.idle_add(self.__render_idle_cb,
+                                            priority=GLib.PRIORITY_LOW)
+
+    def __render_idle_cb(self):
+        # render one visible page at a time, to not block the input
+        visible = self._icon_view.get_visible_range()
+        if visible is None:
+            self._render_id = None
+            return False
+        first_path, last_path = visible
+        for index in range(first_path.get_indices()[0],
+                           last_path.get_indices()[0] + 1):
+            row = self._store[index]
+            if row[2]:
+                continue
+            page = index + 1
+            key = self._get_key(page)
+            pixbuf = self._cache.get(key)
+            if pixbuf is None:
+                pixbuf = self._render(page)
+                self._cache.add(key, pixbuf)
+            row[1] = pixbuf
+            row[2] = True
+            self._shown_keys[page] = key
+            return True
+        self._render_id = None
+        return False
+
+    def __evicted_cb(self, key):
+        page = key[0]
+        if self._shown_keys.get(page) == key:
+            del self._shown_keys[page]
+            row = self._store[page - 1]
+            row[1] = self._placeholder
+            row[2] = False
+
+    def _render(self, page):
+        pixbuf = self._document_view.render_page_to_image(page)
+        height = pixbuf.get_height() * THUMBNAIL_WIDTH / pixbuf.get_width()
+        return pixbuf.scale_simple(THUMBNAIL_WIDTH, max(1, height),
+                                   GdkPixbuf.InterpType.BILINEAR)
+
+    def __item_activated_cb(self, icon_view, path):
+        self._document_view.set_current_page(path.get_indices()[0] + 1)
+        self._document_view.grab_focus()
@@ -22,9 +22,9 @@ import logging
 from gi.repository import Gtk
 from gi.repository import Gdk
 from gi.repository import GObject
+from gi.repository import GLib
 
-import os
-import tempfile
+import re
 from urlparse import urlparse
 
 from sugar3.graphics.toolbutton import ToolButton
@@ -32,6 +32,7 @@ from sugar3.graphics.toolcombobox import ToolComboBox
 from sugar3.graphics.colorbutton import ColorToolButton
 from sugar3.graphics.toggletoolbutton import ToggleToolButton
 from sugar3.graphics.palettemenu import PaletteMenuBox
+from sugar3.graphics.palettemenu import PaletteMenuItem
 from sugar3.graphics import iconentry
 from sugar3.graphics import style
 from sugar3.activity.widgets import CopyButton
@@ -41,12 +42,31 @@ from sugar3.activity.widgets import RedoButton
 
 from widgets import AbiButton
 from widgets import AbiMenuItem
+from widgets import StyleDispatcher
 from fontcombobox import FontComboBox
 from fontcombobox import FontSize
 from gridcreate import GridCreateWidget
+from perfstats import timed
+from textindex import SearchIndex
+from textindex import TextStatistics
+from textindex import compile_query
+from tabledata import parse_table_text
 
 logger = logging.getLogger('write-activity')
 
+# time to wait after the last key typed in the search entry to search
+SEARCH_DELAY = 300
+
+# ms between the checks for changes in the document, the word count is
+# updated once the document did not change for this time
+COUNT_DELAY = 500
+
+# documents with more pages are switched to the draft layout on load
+DRAFT_LAYOUT_PAGES = 50
+
+# maximum rows or columns inserted or deleted at once
+MAX_TABLE_OPERATION = 100
+
 
 class EditToolbar(Gtk.Toolbar):
 
@@ -54,6 +74,7 @@ class EditToolbar(Gtk.Toolbar):
 
         GObject.GObject.__init__(self)
 
+        self._activity = pc
         self._abiword_canvas = pc.abiword_canvas
 
         copy = CopyButton()
@@ -72,26 +93,31 @@ class EditToolbar(Gtk.Toolbar):
         self.insert(separator, -1)
         separator.show()
 
-        undo = UndoButton(sensitive=False)
-        undo.connect('clicked', lambda button: pc.abiword_canvas.undo())
-        pc.abiword_canvas.connect("can-undo", lambda abi, can_undo:
-                                  undo.set_sensitive(can_undo))
-        self.insert(undo, -1)
-        undo.show()
+        self._undo = UndoButton(sensitive=False)
+        self._undo.connect('clicked',
+                           lambda button: pc.abiword_canvas.undo())
+        pc.abiword_canvas.state.connect(
+            self, "can-undo", lambda abi, can_undo:
+            self._undo.set_sensitive(can_undo or abi.can_undo_batch()))
+        self.insert(self._undo, -1)
+        self._undo.show()
 
         redo = RedoButton(sensitive=False)
         redo.connect('clicked', lambda button: pc.abiword_canvas.redo())
-        pc.abiword_canvas.connect("can-redo", lambda abi, can_redo:
-                                  redo.set_sensitive(can_redo))
+        pc.abiword_canvas.state.connect(self, "can-redo",
+                                        lambda abi, can_redo:
+                                        redo.set_sensitive(can_redo))
         self.insert(redo, -1)
         redo.show()
 
-        pc.abiword_canvas.connect('text-selected', lambda abi, b:
-                                  copy.set_sensitive(True))
-        pc.abiword_canvas.connect('image-selected', lambda abi, b:
-                                  copy.set_sensitive(True))
-        pc.abiword_canvas.connect('selection-cleared', lambda abi, b:
-                                  copy.set_sensitive(False))
+        pc.abiword_canvas.state.connect(self, 'text-selected', lambda abi, b:
+                                        copy.set_sensitive(True))
+        pc.abiword_canvas.state.connect(self, 'image-selected',
+                                        lambda abi, b:
+                                        copy.set_sensitive(True))
+        pc.abiword_canvas.state.connect(self, 'selection-cleared',
+                                        lambda abi, b:
+                                        copy.set_sensitive(False))
 
         separator = Gtk.SeparatorToolItem()
         self.insert(separator, -1)
@@ -125,6 +151,38 @@ class EditToolbar(Gtk.Toolbar):
         self._findnext.show()
         self._findnext.connect('clicked', self._findnext_cb)
 
+        self._search_label = Gtk.Label()
+        self._add_widget(self._search_label)
+
+        search_options = ToolButton('preferences-system')
+        search_options.set_tooltip(_('Search options'))
+        search_options.props.hide_tooltip_on_click = False
+        search_options.palette_invoker.props.toggle_palette = True
+        options_box = Gtk.VBox()
+        self._regex_checkbutton = Gtk.CheckButton(_('Regular expression'))
+        self._whole_word_checkbutton = Gtk.CheckButton(_('Whole words'))
+        self._match_case_checkbutton = Gtk.CheckButton(_('Match case'))
+        for checkbutton in (self._regex_checkbutton,
+                            self._whole_word_checkbutton,
+                            self._match_case_checkbutton):
+            checkbutton.connect('toggled', self._search_entry_changed_cb)
+            options_box.pack_start(checkbutton, True, True, 0)
+        replace_box = Gtk.HBox()
+        self._replace_entry = Gtk.Entry()
+        self._replace_entry.set_placeholder_text(_('Replace with'))
+        replace_box.pack_start(self._replace_entry, True, True, 0)
+        self._replace_button = Gtk.Button(_('Replace all'))
+        self._replace_button.connect('clicked', self._replace_all_cb)
+        replace_box.pack_start(self._replace_button, False, False, 0)
+        options_box.pack_start(replace_box, True, True, style.DEFAULT_PADDING)
+        search_options.get_palette().set_content(options_box)
+        options_box.show_all()
+        self.insert(search_options, -1)
+        search_options.show()
+
+        self._search_timeout_id = None
+        self._search_index = None
+
         # set the initial state of the search controls
         # note: we won't simple call self._search_entry_changed_cb
         # here, as that will call into the abiword_canvas, which
@@ -133,73 +191,232 @@ class EditToolbar(Gtk.Toolbar):
         self._findprev.set_sensitive(False)
         self._findnext.set_sensitive(False)
 
+    @timed('EditToolbar.paste_button')
     def __paste_button_cb(self, button):
         clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
-
-        if clipboard.wait_is_image_available():
-            pixbuf_sel = clipboard.wait_for_image()
-            activity = self._abiword_canvas.get_toplevel()
-            temp_path = os.path.join(activity.get_activity_root(), 'instance')
-            if not os.path.exists(temp_path):
-                os.makedirs(temp_path)
-            fd, file_path = tempfile.mkstemp(dir=temp_path, suffix='.png')
-            os.close(fd)
-            logging.error('tempfile is %s' % file_path)
-            success, data = pixbuf_sel.save_to_bufferv('png', [], [])
-            if success:
-                px_file = open(file_path, 'w')
-                px_file.write(data)
-                px_file.close()
-                self._abiword_canvas.insert_image(file_path, False)
-
-        elif clipboard.wait_is_uris_available():
-            selection = clipboard.wait_for_uris()
-            if selection is not None:
-                for uri in selection:
-                    self._abiword_canvas.insert_image(urlparse(uri).path,
-                                                      False)
+        # don't block waiting for the application owning the clipboard
+        clipboard.request_contents(Gdk.atom_intern('TARGETS', False),
+                                   self.__targets_received_cb, None)
+
+    def __targets_received_cb(self, clipboard, selection_data, data):
+        if selection_data.targets_include_image(False):
+            clipboard.request_image(self.__image_received_cb, None)
+        elif selection_data.targets_include_uri():
+            clipboard.request_uris(self.__uris_received_cb, None)
         else:
             self._abiword_canvas.paste()
 
+    def __image_received_cb(self, clipboard, pixbuf, data):
+        if pixbuf is not None:
+            self._activity.insert_image(pixbuf, False)
+
+    def __uris_received_cb(self, clipboard, uris, data):
+        if uris:
+            self._activity.insert_images([urlparse(uri).path for uri in uris],
+                                         False)
+
     def _search_entry_activated_cb(self, entry):
         logger.debug('_search_entry_activated_cb')
         if not self._search_entry.props.text:
             return
 
-        # find the next entry
-        self._abiword_canvas.find_next(False)
+        if self._search_timeout_id is not None:
+            # don't wait to search
+            GLib.source_remove(self._search_timeout_id)
+            self.__search_timeout_cb()
+        else:
+            # find the next entry
+            self._find(1)
 
+    @timed('EditToolbar.search_entry_changed')
     def _search_entry_changed_cb(self, entry):
         logger.debug('_search_entry_changed_cb search for \'%s\'',
                      self._search_entry.props.text)
 
+        if self._search_timeout_id is not None:
+            GLib.source_remove(self._search_timeout_id)
+            self._search_timeout_id = None
+
         if not self._search_entry.props.text:
             self._search_entry.activate()
             # set the button contexts
             self._findprev.set_sensitive(False)
             self._findnext.set_sensitive(False)
+            if self._search_index is not None:
+                self._search_index.destroy()
+                self._search_index = None
+            self._search_label.set_text('')
+            return
+
+        # don't search in the whole document for every key typed
+        self._search_timeout_id = GLib.timeout_add(SEARCH_DELAY,
+                                                   self.__search_timeout_cb)
+
+    def __search_timeout_cb(self):
+        self._search_timeout_id = None
+        self._search()
+        return False
+
+    def _search(self):
+        query = self._search_entry.props.text
+        if self._search_index is not None:
+            self._search_index.destroy()
+            self._search_index = None
+
+        snapshot = self._abiword_canvas.get_snapshot()
+        if snapshot is None:
+            # the document text is not available, use the plain search
+            self._abiword_canvas.set_find_string(query)
+            self._findprev.set_sensitive(True)
+            self._findnext.set_sensitive(True)
+            self._abiword_canvas.find_next(True)
+            self._update_search_label()
             return
 
-        self._abiword_canvas.set_find_string(self._search_entry.props.text)
+        try:
+            self._search_index = SearchIndex(
+                snapshot, query,
+                regex=self._regex_checkbutton.get_active(),
+                whole_word=self._whole_word_checkbutton.get_active(),
+                match_case=self._match_case_checkbutton.get_active())
+        except re.error, e:
+            logger.debug('Invalid search expression %r: %s', query, e)
+            self._findprev.set_sensitive(False)
+            self._findnext.set_sensitive(False)
+            self._search_label.set_text(_('Invalid expression'))
+            return
 
         # set the button contexts
-        self._findprev.set_sensitive(True)
-        self._findnext.set_sensitive(True)
+        found = len(self._search_index) > 0
+        self._findprev.set_sensitive(found)
+        self._findnext.set_sensitive(found)
+
+        # immediately select the first match from the cursor
+        if found:
+            self._select_match_from_cursor()
+        self._update_search_label()
+
+    @timed('EditToolbar.replace_all')
+    def _replace_all_cb(self, button):
+        query = self._search_entry.props.text
+        if not query:
+            return
+        regex = self._regex_checkbutton.get_active()
+        try:
+            pattern = compile_query(
+                query, regex, self._whole_word_checkbutton.get_active(),
+                self._match_case_checkbutton.get_active())
+        except re.error, e:
+            logger.debug('Invalid search expression %r: %s', query, e)
+            self._search_label.set_text(_('Invalid expression'))
+            return
+
+        # the matches counted by the search, to tell if some were not
+        # replaced, like the ones across paragraphs
+        self._abiword_canvas.get_snapshot()
+        index = self._search_index
+        expected = None
+        if index is not None and index.query == query:
+            expected = len(index)
 
-        # immediately start seaching
-        self._abiword_canvas.find_next(True)
+        try:
+            count = self._abiword_canvas.replace_all(
+                pattern, self._replace_entry.props.text, regex)
+        except re.error, e:
+            # invalid group reference in the replacement
+            logger.debug('Invalid replacement: %s', e)
+            self._search_label.set_text(_('Invalid replacement'))
+            return
+
+        if count is None:
+            self._search_label.set_text(_('Replace is not available'))
+            return
+        if count > 0:
+            self._undo.set_sensitive(True)
+            self._search()
+        if expected is not None and count != expected:
+            self._search_label.set_text(
+                _('%(replaced)d of %(total)d replaced') % {
+                    'replaced': count, 'total': expected})
+        else:
+            self._search_label.set_text(_('%d replaced') % count)
+
+    def _is_plain_search(self):
+        return not (self._regex_checkbutton.get_active() or
+                    self._whole_word_checkbutton.get_active() or
+                    self._match_case_checkbutton.get_active())
+
+    def _find(self, step):
+        # update the snapshot, and the index with it, if the text changed
+        self._abiword_canvas.get_snapshot()
+        index = self._search_index
+        if index is not None and len(index) == 0:
+            # nothing to find, don't scan the document again
+            self._update_search_label()
+            return
 
+        if index is not None and index.current is not None:
+            self._select_match((index.current + step) % len(index))
+        elif index is not None and not self._is_plain_search():
+            # the cursor moved, start again from an end of the document
+            self._select_match(0 if step > 0 else len(index) - 1)
+        else:
+            # search from the cursor position with libabiword
+            query = self._search_entry.props.text
+            if self._abiword_canvas.get_find_string() != query:
+                self._abiword_canvas.set_find_string(query)
+            if step > 0:
+                self._abiword_canvas.find_next(False)
+            else:
+                self._abiword_canvas.find_prev()
+        self._update_search_label()
+
+    def _select_match(self, match):
+        text, occurrence, total = self._search_index.get_target(match)
+        if self._abiword_canvas.select_occurrence(text, occurrence, total):
+            self._search_index.current = match
+        else:
+            # too far, the next occurrence from the cursor was selected
+            self._search_index.current = None
+
+    def _select_match_from_cursor(self):
+        # the match at the beginning of the selection stays selected
+        # while typing the query
+        index = self._search_index
+        offset = self._abiword_canvas.get_cursor_offset()
+        match = None
+        if offset is not None:
+            match = index.find_match(offset)
+        if match is None:
+            # after the last match, start again from the beginning
+            self._select_match(0)
+            return
+        text, occurrence, total = index.get_target(match)
+        if self._abiword_canvas.select_next_occurrence(
+                text, index.get_skipped(match, offset), occurrence):
+            index.current = match
+        else:
+            self._select_match(match)
+
+    def _update_search_label(self):
+        if self._search_index is None:
+            self._search_label.set_text('')
+        else:
+            self._search_label.set_text(self._search_index.get_label())
+
+    @timed('EditToolbar.findprev')
     def _findprev_cb(self, button):
         logger.debug('_findprev_cb')
         if self._search_entry.props.text:
-            self._abiword_canvas.find_prev()
+            self._find(-1)
         else:
             logger.debug('nothing to search for!')
 
+    @timed('EditToolbar.findnext')
     def _findnext_cb(self, button):
         logger.debug('_findnext_cb')
         if self._search_entry.props.text:
-            self._abiword_canvas.find_next(False)
+            self._find(1)
         else:
             logger.debug('nothing to search for!')
 
@@ -217,19 +434,34 @@ class EditToolbar(Gtk.Toolbar):
 
 class InsertToolbar(Gtk.Toolbar):
 
-    def __init__(self, abiword_canvas):
+    def __init__(self, abiword_canvas, activity=None):
         GObject.GObject.__init__(self)
 
         self._abiword_canvas = abiword_canvas
+        self._activity = activity
 
         self._table_btn = ToolButton('create-table')
         self._table_btn.set_tooltip(_('Create table'))
         self.insert(self._table_btn, -1)
         self._grid_create = GridCreateWidget()
-        self._grid_create.show()
         self._grid_create.connect('create-table', self._create_table_cb)
+        palette_box = PaletteMenuBox()
+        palette_box.append_item(self._grid_create, vertical_padding=0)
+        palette_box.append_separator()
+
+        paste_table = PaletteMenuItem(_('Paste as table'), 'edit-paste')
+        paste_table.connect('activate', self._paste_table_cb)
+        palette_box.append_item(paste_table)
+
+        if activity is not None:
+            csv_table = PaletteMenuItem(_('Table from CSV file'),
+                                        'document-open')
+            csv_table.connect('activate', self._csv_table_cb)
+            palette_box.append_item(csv_table)
+
+        palette_box.show_all()
         palette = self._table_btn.get_palette()
-        palette.set_content(self._grid_create)
+        palette.set_content(palette_box)
         self._table_btn.connect('clicked', self._table_btn_clicked_cb)
 
         self._table_rows_after = ToolButton('row-insert')
@@ -256,44 +488,106 @@ class InsertToolbar(Gtk.Toolbar):
             'clicked', self._table_delete_cols_cb)
         self.insert(self._table_delete_cols, -1)
 
+        # rows or columns inserted or deleted by the buttons
+        self._table_count = Gtk.SpinButton()
+        self._table_count.set_adjustment(
+            Gtk.Adjustment(1, 1, MAX_TABLE_OPERATION, 1, 5, 0))
+        self._table_count.set_numeric(True)
+        self._table_count.set_tooltip_text(
+            _('Rows or columns to insert or delete'))
+        count_item = Gtk.ToolItem()
+        count_item.add(self._table_count)
+        self.insert(count_item, -1)
+
         self.show_all()
 
-        self._abiword_canvas.connect('table-state', self._isTable_cb)
+        self._abiword_canvas.state.connect(self, 'table-state',
+                                           self._isTable_cb)
         #self._abiword_canvas.connect('image-selected',
         #       self._image_selected_cb)
 
     def _table_btn_clicked_cb(self, button):
         button.get_palette().popup(True, button.get_palette().SECONDARY)
 
+    @timed('InsertToolbar.create_table')
     def _create_table_cb(self, abi, rows, cols):
         self._abiword_canvas.insert_table(rows, cols)
 
+    def _insert_table_with_data(self, text):
+        rows = parse_table_text(text)
+        if not rows:
+            return
+        self._table_btn.get_palette().popdown(True)
+        if not self._abiword_canvas.insert_table_with_data(rows):
+            logger.warning('Could not insert the table of %d rows',
+                           len(rows))
+
+    def _paste_table_cb(self, menu_item):
+        clipboard = Gtk.Clipboard.get(Gdk.SELECTION_CLIPBOARD)
+        # don't block waiting for the application owning the clipboard
+        clipboard.request_text(self.__text_received_cb, None)
+
+    @timed('InsertToolbar.paste_table')
+    def __text_received_cb(self, clipboard, text, data):
+        if text:
+            self._insert_table_with_data(text)
+
+    @timed('InsertToolbar.csv_table')
+    def _csv_table_cb(self, menu_item):
+        jobject = self._activity.choose_text_file()
+        if jobject is None:
+            return
+        csv_file = open(jobject.file_path)
+        try:
+            text = csv_file.read()
+        finally:
+            csv_file.close()
+        self._insert_table_with_data(text)
+
+    def _invoke_table_operation(self, method):
+        count = self._table_count.get_value_as_int()
+        if count == 1:
+            self._abiword_canvas.invoke_ex(method, '', 0, 0)
+        else:
+            self._abiword_canvas.invoke_repeated(method, count)
+
+    @timed('InsertToolbar.table_rows_after')
     def _table_rows_after_cb(self, button):
-        self._abiword_canvas.invoke_ex('insertRowsAfter', '', 0, 0)
+        self._invoke_table_operation('insertRowsAfter')
 
+    @timed('InsertToolbar.table_delete_rows')
     def _table_delete_rows_cb(self, button):
-        self._abiword_canvas.invoke_ex('deleteRows', '', 0, 0)
+        self._invoke_table_operation('deleteRows')
 
+    @timed('InsertToolbar.table_cols_after')
     def _table_cols_after_cb(self, button):
-        self._abiword_canvas.invoke_ex('insertColsAfter', '', 0, 0)
+        self._invoke_table_operation('insertColsAfter')
 
+    @timed('InsertToolbar.table_delete_cols')
     def _table_delete_cols_cb(self, button):
-        self._abiword_canvas.invoke_ex('deleteColumns', '', 0, 0)
+        self._invoke_table_operation('deleteColumns')
 
     def _isTable_cb(self, abi, b):
         self._table_rows_after.set_sensitive(b)
         self._table_delete_rows.set_sensitive(b)
         self._table_cols_after.set_sensitive(b)
         self._table_delete_cols.set_sensitive(b)
+        self._table_count.set_sensitive(b)
 
 
 class ViewToolbar(Gtk.Toolbar):
 
-    def __init__(self, abiword_canvas):
+    def __init__(self, abiword_canvas, outline_panel=None,
+                 thumbnail_panel=None):
         GObject.GObject.__init__(self)
 
         self._abiword_canvas = abiword_canvas
         self._zoom_percentage = 0
+        self._outline_panel = outline_panel
+        self._thumbnail_panel = thumbnail_panel
+        self._draft_layout_pages = DRAFT_LAYOUT_PAGES
+        # the layout was chosen by the user, don't switch automatically
+        self._draft_layout_chosen = False
 
         self._zoom_out = ToolButton('zoom-out')
         self._zoom_out.set_tooltip(_('Zoom Out'))
@@ -334,6 +628,16 @@ class ViewToolbar(Gtk.Toolbar):
         self.insert(tool_item_zoom_perc_label, -1)
         tool_item_zoom_perc_label.show()
 
+        self._draft_button = ToggleToolButton('view-freeform')
+        self._draft_button.set_tooltip(_('Draft layout'))
+        self._draft_button_id = self._draft_button.connect(
+            'toggled', self._draft_toggled_cb)
+        # view_normal_layout is not available in older libabiword versions
+        self._draft_button.set_sensitive(
+            abiword_canvas.can_draft_layout())
+        self.insert(self._draft_button, -1)
+        self._draft_button.show()
+
         separator = Gtk.SeparatorToolItem()
         separator.set_draw(True)
         separator.show()
@@ -364,13 +668,107 @@ class ViewToolbar(Gtk.Toolbar):
         self.insert(tool_item, -1)
         tool_item.show()
 
-        self._abiword_canvas.connect("page-count", self._page_count_cb)
-        self._abiword_canvas.connect("current-page", self._current_page_cb)
-        self._abiword_canvas.connect("zoom", self._zoom_cb)
+        # due to http://bugzilla.abisource.com/show_bug.cgi?id=13585
+        self._statistics = None
+        self._page_count = 0
+        self._count_timeout_id = None
+        self._count_revision = None
+        self._poll_revision = None
+        if abiword_canvas.get_version() != '3.0':
+            separator = Gtk.SeparatorToolItem()
+            separator.set_draw(True)
+            separator.show()
+            self.insert(separator, -1)
+
+            self._count_label = Gtk.Label()
+            self._count_label.show()
+            tool_item = Gtk.ToolItem()
+            tool_item.add(self._count_label)
+            self.insert(tool_item, -1)
+            tool_item.show()
+
+            # only counted while the toolbar is visible
+            self.connect('map', self.__count_map_cb)
+            self.connect('unmap', self.__count_unmap_cb)
+
+        if outline_panel is not None:
+            separator = Gtk.SeparatorToolItem()
+            separator.set_draw(True)
+            separator.show()
+            self.insert(separator, -1)
+
+            outline_button = ToggleToolButton('view-list')
+            outline_button.set_tooltip(_('Outline'))
+            outline_button.connect('toggled', self._outline_toggled_cb)
+            # the headings are read from the document content, due to
+            # http://bugzilla.abisource.com/show_bug.cgi?id=13585
+            outline_button.set_sensitive(
+                abiword_canvas.get_version() != '3.0')
+            self.insert(outline_button, -1)
+            outline_button.show()
+
+        if thumbnail_panel is not None:
+            thumbnail_button = ToggleToolButton('view-thumbnails')
+            thumbnail_button.set_tooltip(_('Pages'))
+            thumbnail_button.connect('toggled', self._thumbnail_toggled_cb)
+            # not available yet on upstream abiword
+            thumbnail_button.set_sensitive(
+                hasattr(abiword_canvas, 'render_page_to_image'))
+            self.insert(thumbnail_button, -1)
+            thumbnail_button.show()
+
+        self._abiword_canvas.state.connect(self, "page-count",
+                                           self._page_count_cb)
+        self._abiword_canvas.state.connect(self, "current-page",
+                                           self._current_page_cb)
+        self._abiword_canvas.state.connect(self, "zoom", self._zoom_cb)
+        # even if the toolbar is not visible
+        self._abiword_canvas.connect("page-count", self._auto_draft_cb)
+
+    def __count_map_cb(self, widget):
+        self._update_count()
+        self._count_timeout_id = GLib.timeout_add(COUNT_DELAY,
+                                                  self.__count_timeout_cb)
+
+    def __count_unmap_cb(self, widget):
+        if self._count_timeout_id is not None:
+            GLib.source_remove(self._count_timeout_id)
+            self._count_timeout_id = None
+
+    def __count_timeout_cb(self):
+        revision = self._abiword_canvas.get_revision()
+        if revision != self._poll_revision:
+            # still typing, getting the text is too expensive to do it
+            # on every check
+            self._poll_revision = revision
+            return True
+        self._update_count()
+        return True
+
+    def _update_count(self):
+        revision = self._abiword_canvas.get_revision()
+        self._poll_revision = revision
+        if revision == self._count_revision:
+            return
+        self._count_revision = revision
+
+        # the snapshot only counts again the changed paragraphs
+        snapshot = self._abiword_canvas.get_snapshot()
+        if self._statistics is None:
+            self._statistics = TextStatistics(snapshot)
+        self._set_count_label()
+
+    def _set_count_label(self):
+        self._count_label.set_text(
+            _('%(words)d words, %(characters)d characters, '
+              '%(pages)d pages') % {
+                'words': self._statistics.words,
+                'characters': self._statistics.characters,
+                'pages': self._page_count})
 
     def set_zoom_percentage(self, zoom):
         self._zoom_percentage = zoom
-        self._abiword_canvas.set_zoom_percentage(self._zoom_percentage)
+        self._abiword_canvas.request_zoom(self._zoom_percentage)
 
     def _zoom_cb(self, canvas, zoom):
         self._zoom_spin.handler_block(self._zoom_spin_id)
@@ -379,26 +777,48 @@ class ViewToolbar(Gtk.Toolbar):
         finally:
             self._zoom_spin.handler_unblock(self._zoom_spin_id)
 
+    @timed('ViewToolbar.zoom_out')
     def _zoom_out_cb(self, button):
         if self._zoom_percentage == 0:
             self._zoom_percentage = self._abiword_canvas.get_zoom_percentage()
         if self._zoom_percentage >= 50:
             self.set_zoom_percentage(self._zoom_percentage - 25)
 
+    @timed('ViewToolbar.zoom_in')
     def _zoom_in_cb(self, button):
         if self._zoom_percentage == 0:
             self._zoom_percentage = self._abiword_canvas.get_zoom_percentage()
         if self._zoom_percentage <= 375:
             self.set_zoom_percentage(self._zoom_percentage + 25)
 
+    @timed('ViewToolbar.zoom_to_width')
     def _zoom_to_width_cb(self, button):
         self._abiword_canvas.zoom_width()
         self._zoom_percentage = self._abiword_canvas.get_zoom_percentage()
 
+    @timed('ViewToolbar.zoom_spin')
     def _zoom_spin_cb(self, button):
         self._zoom_percentage = self._zoom_spin.get_value_as_int()
-        self._abiword_canvas.set_zoom_percentage(self._zoom_percentage)
+        self._abiword_canvas.request_zoom(self._zoom_percentage)
+
+    @timed('ViewToolbar.outline')
+    def _outline_toggled_cb(self, button):
+        self._outline_panel.set_visible(button.get_active())
 
+    @timed('ViewToolbar.thumbnails')
+    def _thumbnail_toggled_cb(self, button):
+        self._thumbnail_panel.set_visible(button.get_active())
+
+    def set_draft_layout_pages(self, pages):
+        """Documents with more pages are switched to the draft layout"""
+        self._draft_layout_pages = pages
+
+    @timed('ViewToolbar.draft_layout')
+    def _draft_toggled_cb(self, button):
+        self._draft_layout_chosen = True
+        self._abiword_canvas.set_draft_layout(button.get_active())
+
+    @timed('ViewToolbar.page_spin')
     def _page_spin_cb(self, button):
         page_num = self._page_spin.get_value_as_int()
         self._abiword_canvas.set_current_page(page_num)
@@ -408,6 +828,22 @@ class ViewToolbar(Gtk.Toolbar):
         self._page_spin_adj.configure(current_page, 1, count, -1, -1, 0)
         self._total_page_label.props.label = \
             ' / ' + str(count)
+        self._page_count = count
+        if self._statistics is not None:
+            self._set_count_label()
+
+    def _auto_draft_cb(self, canvas, count):
+        if count > self._draft_layout_pages and \
+                not self._draft_layout_chosen and \
+                not canvas.get_draft_layout() and canvas.can_draft_layout():
+            # paginating a long document slows down every edit
+            logger.debug('Switching to draft layout, %d pages', count)
+            canvas.set_draft_layout(True)
+            self._draft_button.handler_block(self._draft_button_id)
+            try:
+                self._draft_button.set_active(True)
+            finally:
+                self._draft_button.handler_unblock(self._draft_button_id)
 
     def _current_page_cb(self, canvas, num):
         self._page_spin.handler_block(self._page_spin_id)
@@ -426,13 +862,13 @@ class TextToolbar(Gtk.Toolbar):
         self.font_name_combo.set_font_name('Sans')
         self._fonts_changed_id = self.font_name_combo.connect(
             'changed', self._font_changed_cb, abiword_canvas)
-        self._abi_handler = abiword_canvas.connect('font-family',
-                                                   self._font_family_cb)
+        self._abi_handler = abiword_canvas.state.connect(
+            self, 'font-family', self._font_family_cb)
         self.insert(ToolComboBox(self.font_name_combo), -1)
 
         self.font_size = FontSize()
-        self._abi_handler = abiword_canvas.connect('font-size',
-                                                   self._font_size_cb)
+        self._abi_handler = abiword_canvas.state.connect(
+            self, 'font-size', self._font_size_cb)
         self._changed_id = self.font_size.connect(
             'changed', self._font_size_changed_cb, abiword_canvas)
         self.insert(self.font_size, -1)
@@ -440,30 +876,32 @@ class TextToolbar(Gtk.Toolbar):
         bold = ToggleToolButton('format-text-bold')
         bold.set_tooltip(_('Bold'))
         bold.props.accelerator = '<Ctrl>B'
-        bold_id = bold.connect('clicked', lambda sender:
-                               abiword_canvas.toggle_bold())
-        abiword_canvas.connect('bold', lambda abi, b:
-                               self._setToggleButtonState(bold, b, bold_id))
+        bold_id = bold.connect('clicked', timed('TextToolbar.bold')(
+            lambda sender: abiword_canvas.toggle_bold()))
+        abiword_canvas.state.connect(
+            self, 'bold', lambda abi, b:
+            self._setToggleButtonState(bold, b, bold_id))
         self.insert(bold, -1)
 
         italic = ToggleToolButton('format-text-italic')
         italic.set_tooltip(_('Italic'))
         italic.props.accelerator = '<Ctrl>I'
-        italic_id = italic.connect('clicked', lambda sender:
-                                   abiword_canvas.toggle_italic())
-        abiword_canvas.connect('italic', lambda abi, b:
-                               self._setToggleButtonState(italic, b,
-                                                          italic_id))
+        italic_id = italic.connect('clicked', timed('TextToolbar.italic')(
+            lambda sender: abiword_canvas.toggle_italic()))
+        abiword_canvas.state.connect(
+            self, 'italic', lambda abi, b:
+            self._setToggleButtonState(italic, b, italic_id))
         self.insert(italic, -1)
 
         underline = ToggleToolButton('format-text-underline')
         underline.set_tooltip(_('Underline'))
         underline.props.accelerator = '<Ctrl>U'
-        underline_id = underline.connect('clicked', lambda sender:
-                                         abiword_canvas.toggle_underline())
-        abiword_canvas.connect('underline', lambda abi, b:
-                               self._setToggleButtonState(underline, b,
-                                                          underline_id))
+        underline_id = underline.connect(
+            'clicked', timed('TextToolbar.underline')(
+                lambda sender: abiword_canvas.toggle_underline()))
+        abiword_canvas.state.connect(
+            self, 'underline', lambda abi, b:
+            self._setToggleButtonState(underline, b, underline_id))
         self.insert(underline, -1)
 
         color = ColorToolButton()
@@ -472,8 +910,8 @@ class TextToolbar(Gtk.Toolbar):
         tool_item = Gtk.ToolItem()
         tool_item.add(color)
         self.insert(tool_item, -1)
-        abiword_canvas.connect(
-            'color', lambda abi, r, g, b:
+        abiword_canvas.state.connect(
+            self, 'color', lambda abi, r, g, b:
             color.set_color(Gdk.Color(r * 256, g * 256, b * 256)))
 
         # MAGIC NUMBER WARNING: Secondary toolbars are not a standard height?
@@ -515,24 +953,26 @@ class TextToolbar(Gtk.Toolbar):
 
         self.show_all()
 
+    @timed('TextToolbar.font_changed')
     def _font_changed_cb(self, combobox, abi):
         logger.debug('Setting font: %s', combobox.get_font_name())
         try:
-            abi.handler_block(self._abi_handler)
+            abi.state.handler_block(self._abi_handler)
             abi.set_font_name(combobox.get_font_name())
         finally:
-            abi.handler_unblock(self._abi_handler)
+            abi.state.handler_unblock(self._abi_handler)
 
     def _font_family_cb(self, abi, font_family):
         logging.debug('Abiword font changed to %s', font_family)
         self.font_name_combo.set_font_name(font_family)
 
+    @timed('TextToolbar.font_size_changed')
     def _font_size_changed_cb(self, widget, abi):
-        abi.handler_block(self._abi_handler)
+        abi.state.handler_block(self._abi_handler)
         try:
             abi.set_font_size(str(widget.get_font_size()))
         finally:
-            abi.handler_unblock(self._abi_handler)
+            abi.state.handler_unblock(self._abi_handler)
 
     def _font_size_cb(self, abi, size):
         logging.debug('Abiword font size changed to %s', size)
@@ -545,6 +985,7 @@ class TextToolbar(Gtk.Toolbar):
         button.set_active(b)
         button.handler_unblock(id)
 
+    @timed('TextToolbar.text_color')
     def _text_color_cb(self, button, pspec, abiword_canvas):
         newcolor = button.get_color()
         abiword_canvas.set_text_color(int(newcolor.red / 256.0),
@@ -557,57 +998,45 @@ class ParagraphToolbar(Gtk.Toolbar):
     def __init__(self, abi):
         GObject.GObject.__init__(self)
 
-        def append_style(icon_name, tooltip, do_abi_cb, on_abi_cb):
-            button = AbiButton(abi, 'style-name', do_abi_cb, on_abi_cb)
+        # a single style-name handler for every group of widgets
+        style_dispatcher = StyleDispatcher(abi, self)
+
+        def append_style(icon_name, tooltip, style_name, style_names):
+            button = AbiButton(abi, 'style-name',
+                               lambda: abi.set_style(style_name),
+                               dispatcher=style_dispatcher)
             button.props.icon_name = icon_name
             button.props.group = group
             button.props.tooltip = tooltip
             self.insert(button, -1)
+            style_dispatcher.add(button, style_names)
             return button
 
         group = None
 
-        group = append_style(
-            'list-none', _('Normal'),
-            lambda: abi.set_style('Normal'),
-            lambda abi, style: style not in [
-                'Heading 1', 'Heading 2', 'Heading 3', 'Heading 4',
-                'Block Text', 'Plain Text'])
+        # selected for the styles without button
+        group = append_style('list-none', _('Normal'), 'Normal', None)
 
-        append_style('paragraph-h1', _('Heading 1'),
-                     lambda: abi.set_style('Heading 1'),
-                     lambda abi, style: style == 'Heading 1')
+        append_style('paragraph-h1', _('Heading 1'), 'Heading 1',
+                     ['Heading 1'])
 
-        append_style('paragraph-h2', _('Heading 2'),
-                     lambda: abi.set_style('Heading 2'),
-                     lambda abi, style: style == 'Heading 2')
+        append_style('paragraph-h2', _('Heading 2'), 'Heading 2',
+                     ['Heading 2'])
 
-        append_style('paragraph-h3', _('Heading 3'),
-                     lambda: abi.set_style('Heading 3'),
-                     lambda abi, style: style == 'Heading 3')
+        append_style('paragraph-h3', _('Heading 3'), 'Heading 3',
+                     ['Heading 3'])
 
-        append_style('paragraph-h4', _('Heading 4'),
-                     lambda: abi.set_style('Heading 4'),
-                     lambda abi, style: style == 'Heading 4')
+        append_style('paragraph-h4', _('Heading 4'), 'Heading 4',
+                     ['Heading 4'])
 
-        append_style('paragraph-blocktext', _('Block Text'),
-                     lambda: abi.set_style('Block Text'),
-                     lambda abi, style: style == 'Block Text')
+        append_style('paragraph-blocktext', _('Block Text'), 'Block Text',
+                     ['Block Text'])
 
-        append_style('paragraph-plaintext', _('Plain Text'),
-                     lambda: abi.set_style('Plain Text'),
-                     lambda abi, style: style == 'Plain Text')
+        append_style('paragraph-plaintext', _('Plain Text'), 'Plain Text',
+                     ['Plain Text'])
 
         self.insert(Gtk.SeparatorToolItem(), -1)
 
-        def append_list(icon_name, tooltip, do_abi_cb, on_abi_cb, button,
-                        menu_box, button_icon=None):
-            menu_item = AbiMenuItem(
-                abi, 'style-name', do_abi_cb,
-                icon_name, tooltip, button, on_abi_cb, button_icon)
-            menu_box.append_item(menu_item)
-            menu_item.show()
-
         list_btn = ToolButton(icon_name='toolbar-bulletlist')
         list_btn.props.tooltip = _('Select list')
         list_btn.props.hide_tooltip_on_click = False
@@ -617,40 +1046,36 @@ class ParagraphToolbar(Gtk.Toolbar):
         list_btn.props.palette.set_content(menu_box)
         menu_box.show()
 
-        append_list('list-none', _('Normal'),
-                    lambda: abi.set_style('Normal'),
-                    lambda abi, style:
-                    style not in ['Bullet List',
-                                  'Dashed List',
-                                  'Numbered List',
-                                  'Lower Case List',
-                                  'Upper Case List'],
-                    list_btn, menu_box, 'toolbar-bulletlist')
-
-        append_list('list-bullet', _('Bullet List'),
-                    lambda: abi.set_style('Bullet List'),
-                    lambda abi, style: style == 'Bullet List', list_btn,
-                    menu_box)
-
-        append_list('list-dashed', _('Dashed List'),
-                    lambda: abi.set_style('Dashed List'),
-                    lambda abi, style: style == 'Dashed List', list_btn,
-                    menu_box)
-
-        append_list('list-numbered', _('Numbered List'),
-                    lambda: abi.set_style('Numbered List'),
-                    lambda abi, style: style == 'Numbered List', list_btn,
-                    menu_box)
+        list_dispatcher = StyleDispatcher(abi, list_btn)
+
+        def append_list(icon_name, tooltip, style_name, style_names,
+                        button_icon=None):
+            menu_item = AbiMenuItem(
+                abi, 'style-name', lambda: abi.set_style(style_name),
+                icon_name, tooltip, list_btn, None, button_icon,
+                dispatcher=list_dispatcher)
+            menu_box.append_item(menu_item)
+            menu_item.show()
+            list_dispatcher.add(menu_item, style_names)
+
+        # selected for the styles that are not lists
+        append_list('list-none', _('Normal'), 'Normal', None,
+                    'toolbar-bulletlist')
+
+        append_list('list-bullet', _('Bullet List'), 'Bullet List',
+                    ['Bullet List'])
+
+        append_list('list-dashed', _('Dashed List'), 'Dashed List',
+                    ['Dashed List'])
+
+        append_list('list-numbered', _('Numbered List'), 'Numbered List',
+                    ['Numbered List'])
 
         append_list('list-lower-case', _('Lower Case List'),
-                    lambda: abi.set_style('Lower Case List'),
-                    lambda abi, style: style == 'Lower Case List', list_btn,
-                    menu_box)
+                    'Lower Case List', ['Lower Case List'])
 
         append_list('list-upper-case', _('Upper Case List'),
-                    lambda: abi.set_style('Upper Case List'),
-                    lambda abi, style: style == 'Upper Case List', list_btn,
-                    menu_box)
+                    'Upper Case List', ['Upper Case List'])
 
         self.insert(list_btn, -1)
 
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 One Laptop Per Child
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+Micro benchmarks for the toolbars, using FakeAbiWidget instead of
+libabiword.
+
+Measures the construction time of every toolbar class and the cost of
+dispatching the abiword signals through the StateAggregator to the
+AbiButton, AbiMenuItem and TextToolbar handlers. The widgets are placed
+in an offscreen window, but Gtk still needs a display, use xvfb-run to
+run it headless:
+
+    xvfb-run python toolbarbench.py --output toolbars.json
+"""
+
+import sys
+import json
+import time
+from optparse import OptionParser
+
+from gi.repository import Gtk
+
+from fakeabi import FakeAbiWidget
+
+STYLES = ['Normal', 'Heading 1', 'Heading 2', 'Heading 3', 'Heading 4',
+          'Block Text', 'Plain Text', 'Bullet List', 'Dashed List',
+          'Numbered List', 'Lower Case List', 'Upper Case List']
+
+
+class _FakeActivity(object):
+    """The part of AbiWordActivity used by the EditToolbar"""
+
+    def __init__(self, abiword_canvas):
+        self.abiword_canvas = abiword_canvas
+
+
+def _flush_events():
+    while Gtk.events_pending():
+        Gtk.main_iteration()
+
+
+def _stats(name, times):
+    times = sorted(times)
+    count = len(times)
+    return {'name': name,
+            'count': count,
+            'mean_us': sum(times) / count * 1e6,
+            'min_us': times[0] * 1e6,
+            'p50_us': times[count // 2] * 1e6,
+            'p95_us': times[min(count - 1, int(count * 0.95))] * 1e6,
+            'max_us': times[-1] * 1e6}
+
+
+def _measure(func, iterations):
+    times = []
+    for i in range(iterations):
+        start = time.time()
+        func(i)
+        times.append(time.time() - start)
+    return times
+
+
+def _create_toolbars(abi):
+    from toolbar import EditToolbar
+    from toolbar import ViewToolbar
+    from toolbar import TextToolbar
+    from toolbar import InsertToolbar
+    from toolbar import ParagraphToolbar
+
+    return [('EditToolbar', lambda: EditToolbar(_FakeActivity(abi), None)),
+            ('ViewToolbar', lambda: ViewToolbar(abi)),
+            ('TextToolbar', lambda: TextToolbar(abi)),
+            ('ParagraphToolbar', lambda: ParagraphToolbar(abi)),
+            ('InsertToolbar', lambda: InsertToolbar(abi))]
+
+
+def bench_construction(iterations):
+    results = []
+    for name, factory in _create_toolbars(FakeAbiWidget()):
+        window = Gtk.OffscreenWindow()
+        box = Gtk.VBox()
+        window.add(box)
+        window.show_all()
+
+        def construct(i):
+            toolbar = factory()
+            box.pack_start(toolbar, False, False, 0)
+            _flush_events()
+            toolbar.destroy()
+
+        results.append(_stats('construct:' + name,
+                              _measure(construct, iterations)))
+        window.destroy()
+    return results
+
+
+def bench_dispatch(iterations):
+    abi = FakeAbiWidget()
+    window = Gtk.OffscreenWindow()
+    box = Gtk.VBox()
+    window.add(box)
+    toolbars = {}
+    for name, factory in _create_toolbars(abi):
+        toolbars[name] = factory()
+        box.pack_start(toolbars[name], False, False, 0)
+    window.show_all()
+    _flush_events()
+
+    from widgets import AbiButton
+    from widgets import AbiMenuItem
+
+    paragraph = toolbars['ParagraphToolbar']
+    buttons = [child for child in paragraph.get_children() if
+               isinstance(child, AbiButton)]
+    menu_items = []
+    for child in paragraph.get_children() + \
+            toolbars['TextToolbar'].get_children():
+        palette = getattr(child.props, 'palette', None)
+        if palette is None or palette.get_content() is None:
+            continue
+        for item in palette.get_content().get_children():
+            if isinstance(item, AbiMenuItem):
+                menu_items.append(item)
+
+    def emit(*args):
+        # the toolbars are updated once per frame, dispatch immediately
+        abi.emit(*args)
+        abi.state.flush()
+
+    def cursor_move(i):
+        for n in range(4):
+            abi.emit('bold', (i + n) % 2 == 0)
+            abi.emit('italic', False)
+            abi.emit('underline', False)
+            abi.emit('font-family', 'Sans')
+            abi.emit('font-size', '12')
+            abi.emit('color', 0, 0, 0)
+            abi.emit('style-name', STYLES[(i + n) % len(STYLES)])
+            abi.emit('current-page', 1)
+        abi.state.flush()
+
+    cases = [
+        ('signal:style-name',
+         lambda i: emit('style-name', STYLES[i % len(STYLES)])),
+        ('signal:bold', lambda i: emit('bold', i % 2 == 0)),
+        ('signal:left-align', lambda i: emit('left-align', i % 2 == 0)),
+        ('signal:font-family',
+         lambda i: emit('font-family', ('Sans', 'Serif')[i % 2])),
+        ('signal:font-size', lambda i: emit('font-size', str(10 + i % 8))),
+        ('signal:color', lambda i: emit('color', i % 256, 0, 0)),
+        ('signal:page-count', lambda i: emit('page-count', 1 + i % 50)),
+        ('signal:current-page',
+         lambda i: emit('current-page', 1 + i % 50)),
+        ('signal:zoom', lambda i: emit('zoom', 50 + i % 10 * 25)),
+        ('signal:table-state', lambda i: emit('table-state', i % 2 == 0)),
+        ('signal:can-undo', lambda i: emit('can-undo', i % 2 == 0)),
+        # the signals emitted when the cursor moves, dispatched once
+        ('burst:cursor-move', cursor_move),
+        ('AbiButton.toggled',
+         lambda i: buttons[i % len(buttons)].set_active(True)),
+        ('AbiMenuItem.activate',
+         lambda i: menu_items[i % len(menu_items)].emit('activate')),
+        ('TextToolbar.font_size_changed',
+         lambda i: toolbars['TextToolbar'].font_size.set_font_size(
+             10 + i % 8)),
+    ]
+
+    results = []
+    for name, func in cases:
+        results.append(_stats(name, _measure(func, iterations)))
+    window.destroy()
+    return results
+
+
+def bench_style_dispatch(iterations):
+    """
+    Compare one style-name handler per button, testing the style, with a
+    single StyleDispatcher looking up the button.
+    """
+    from widgets import AbiButton
+    from widgets import StyleDispatcher
+
+    results = []
+    for name in ('per-button', 'dispatcher'):
+        abi = FakeAbiWidget()
+        window = Gtk.OffscreenWindow()
+        toolbar = Gtk.Toolbar()
+        window.add(toolbar)
+        dispatcher = StyleDispatcher(abi, toolbar)
+        group = None
+        for style_name in STYLES:
+            if name == 'per-button':
+                button = AbiButton(abi, 'style-name', lambda: None,
+                                   lambda abi, style, style_name=style_name:
+                                   style == style_name)
+            else:
+                button = AbiButton(abi, 'style-name', lambda: None,
+                                   dispatcher=dispatcher)
+                dispatcher.add(button, [style_name])
+            button.props.group = group
+            group = button
+            toolbar.insert(button, -1)
+        window.show_all()
+        _flush_events()
+
+        def emit(i):
+            abi.emit('style-name', STYLES[i % len(STYLES)])
+            abi.state.flush()
+
+        results.append(_stats('style-name:' + name,
+                              _measure(emit, iterations)))
+        window.destroy()
+    return results
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--output', help='write the results as json to a file')
+    parser.add_option('--construct-iterations', type='int', default=20)
+    parser.add_option('--dispatch-iterations', type='int', default=2000)
+    options, args = parser.parse_args()
+
+    results = bench_construction(options.construct_iterations)
+    results.extend(bench_dispatch(options.dispatch_iterations))
+    results.extend(bench_style_dispatch(options.dispatch_iterations))
+
+    for result in results:
+        sys.stdout.write('%(name)-32s %(count)6d %(mean_us)10.1f us '
+                         '(p50 %(p50_us).1f, p95 %(p95_us).1f)\n' % result)
+
+    if options.output:
+        report = open(options.output, 'w')
+        try:
+            json.dump({'timestamp': time.time(), 'results': results},
+                      report, indent=1, sort_keys=True)
+        finally:
+            report.close()
+
+if __name__ == '__main__':
+    main()
@@ -20,46 +20,133 @@ import logging
 
 from gi.repository import Abi
 from gi.repository import GLib
+from gi.repository import Gtk
+from gi.repository import Gdk
+from gi.repository import Pango
 
 from sugar3.graphics.radiotoolbutton import RadioToolButton
 from sugar3.graphics.toolbutton import ToolButton
 from sugar3.graphics.palettemenu import PaletteMenuItem
+from sugar3.graphics import style
 from sugar3.datastore import datastore
 
 from sugar3.activity.activity import SCOPE_PRIVATE
 
+from perfstats import Histogram
+from perfstats import PAINT_STATS_ENV
+from perfstats import timed
+from abistate import StateAggregator
+from textindex import TextSnapshot
+from textindex import OutlineIndex
+from textindex import plan_replacements
+
 logger = logging.getLogger('write-activity')
 
+# ms without zoom requests before the document is laid out at the new zoom
+ZOOM_DELAY = 300
+
+# ms between the checks for changes in the document, while the outline
+# is visible
+OUTLINE_DELAY = 1000
+
+# maximum searches to select a match counting from an end of the document,
+# further ones are searched from the cursor
+MAX_FIND_STEPS = 100
+
+# keys that don't change the document, pressed alone or with control
+_NAVIGATION_KEYS = frozenset([
+    Gdk.KEY_Left, Gdk.KEY_Right, Gdk.KEY_Up, Gdk.KEY_Down, Gdk.KEY_Home,
+    Gdk.KEY_End, Gdk.KEY_Page_Up, Gdk.KEY_Page_Down, Gdk.KEY_KP_Left,
+    Gdk.KEY_KP_Right, Gdk.KEY_KP_Up, Gdk.KEY_KP_Down, Gdk.KEY_KP_Home,
+    Gdk.KEY_KP_End, Gdk.KEY_KP_Page_Up, Gdk.KEY_KP_Page_Down,
+    Gdk.KEY_Shift_L, Gdk.KEY_Shift_R, Gdk.KEY_Control_L, Gdk.KEY_Control_R,
+    Gdk.KEY_Alt_L, Gdk.KEY_Alt_R, Gdk.KEY_Super_L, Gdk.KEY_Super_R,
+    Gdk.KEY_Caps_Lock, Gdk.KEY_Escape, Gdk.KEY_Insert])
+# keys that don't change the document pressed with control: copy, select
+# all, find
+_CONTROL_READ_KEYS = frozenset([
+    Gdk.KEY_c, Gdk.KEY_C, Gdk.KEY_a, Gdk.KEY_A, Gdk.KEY_f, Gdk.KEY_F])
+
+
+class StyleDispatcher(object):
+    """
+    Single handler of the style-name signal for a group of AbiButtons or
+    AbiMenuItems, instead of one handler per widget testing the style.
+    The widget of every style is found in a table, and is only updated
+    if it is not already the selected one.
+    """
+
+    def __init__(self, abi, widget):
+        self._widgets = {}
+        self._default = None
+        self._current = None
+        self.handler_id = abi.state.connect(widget, 'style-name',
+                                            self.__style_name_cb)
+
+    def add(self, widget, style_names):
+        """
+        Select the widget for the given styles, or for the styles not
+        added if style_names is None.
+        """
+        if style_names is None:
+            self._default = widget
+        else:
+            for style_name in style_names:
+                self._widgets[style_name] = widget
+
+    def set_current(self, widget):
+        """The widget was selected by the user"""
+        self._current = widget
+
+    def __style_name_cb(self, abi, style_name):
+        widget = self._widgets.get(style_name, self._default)
+        if widget is None or widget is self._current:
+            return
+        logging.debug('On abi style-name %r', style_name)
+        self._current = widget
+        widget.select()
+
 
 class AbiButton(RadioToolButton):
 
-    def __init__(self, abi, abi_signal, do_abi_cb, on_abi_cb=None, **kwargs):
+    def __init__(self, abi, abi_signal, do_abi_cb, on_abi_cb=None,
+                 dispatcher=None, **kwargs):
         RadioToolButton.__init__(self, **kwargs)
 
-        self._abi_handler = abi.connect(abi_signal, self.__abi_cb,
-                                        abi_signal, on_abi_cb)
+        self._dispatcher = dispatcher
+        if dispatcher is None:
+            self._abi_handler = abi.state.connect(
+                self, abi_signal, self.__abi_cb, abi_signal, on_abi_cb)
+        else:
+            self._abi_handler = dispatcher.handler_id
         self._toggled_handler = self.connect('toggled', self.__toggled_cb,
                                              abi, do_abi_cb)
 
+    @timed('AbiButton.toggled', lambda self, *args: self.props.icon_name)
     def __toggled_cb(self, button, abi, do_abi_cb):
         if not button.props.active:
             return
 
-        abi.handler_block(self._abi_handler)
+        abi.state.handler_block(self._abi_handler)
         try:
             logging.debug('Do abi %s' % do_abi_cb)
             do_abi_cb()
+            if self._dispatcher is not None:
+                self._dispatcher.set_current(self)
         finally:
-            abi.handler_unblock(self._abi_handler)
+            abi.state.handler_unblock(self._abi_handler)
 
     def __abi_cb(self, abi, prop, abi_signal, on_abi_cb):
         if (on_abi_cb is None and not prop) or \
                 (on_abi_cb is not None and not on_abi_cb(abi, prop)):
             return
 
+        logging.debug('On abi %s prop=%r' % (abi_signal, prop))
+        self.select()
+
+    def select(self):
         self.handler_block(self._toggled_handler)
         try:
-            logging.debug('On abi %s prop=%r' % (abi_signal, prop))
             self.set_active(True)
         finally:
             self.handler_unblock(self._toggled_handler)
@@ -68,7 +155,8 @@ class AbiButton(RadioToolButton):
 class AbiMenuItem(PaletteMenuItem):
 
     def __init__(self, abi, abi_signal, do_abi_cb, icon_name, label,
-                 button, on_abi_cb=None, button_icon_name=None):
+                 button, on_abi_cb=None, button_icon_name=None,
+                 dispatcher=None):
         self._icon_name = icon_name
         # _button_icon_name is used only in the first case of
         # the list menu
@@ -76,10 +164,16 @@ class AbiMenuItem(PaletteMenuItem):
         self._button = button
         PaletteMenuItem.__init__(self, icon_name=icon_name, text_label=label)
 
-        self._abi_handler = abi.connect(abi_signal, self.__abi_cb,
-                                        abi_signal, on_abi_cb)
+        # the menu item updates the icon of the button
+        self._dispatcher = dispatcher
+        if dispatcher is None:
+            self._abi_handler = abi.state.connect(
+                button, abi_signal, self.__abi_cb, abi_signal, on_abi_cb)
+        else:
+            self._abi_handler = dispatcher.handler_id
         self.connect('activate', self.__activated_cb, abi, do_abi_cb)
 
+    @timed('AbiMenuItem.activated', lambda self, *args: self._icon_name)
     def __activated_cb(self, button, abi, do_abi_cb):
 
         if self._button_icon_name is not None:
@@ -89,16 +183,15 @@ class AbiMenuItem(PaletteMenuItem):
             if self._button.get_icon_name() == self._icon_name:
                 return
 
-        abi.handler_block(self._abi_handler)
+        abi.state.handler_block(self._abi_handler)
         try:
             logging.debug('Do abi %s' % do_abi_cb)
             do_abi_cb()
-            if self._button_icon_name is not None:
-                self._button.set_icon_name(self._button_icon_name)
-            else:
-                self._button.set_icon_name(self._icon_name)
+            self.select()
+            if self._dispatcher is not None:
+                self._dispatcher.set_current(self)
         finally:
-            abi.handler_unblock(self._abi_handler)
+            abi.state.handler_unblock(self._abi_handler)
 
     def __abi_cb(self, abi, prop, abi_signal, on_abi_cb):
         if (on_abi_cb is None and not prop) or \
@@ -106,6 +199,9 @@ class AbiMenuItem(PaletteMenuItem):
             return
 
         logging.debug('On abi %s prop=%r' % (abi_signal, prop))
+        self.select()
+
+    def select(self):
         if self._button_icon_name is not None:
             self._button.set_icon_name(self._button_icon_name)
         else:
@@ -190,8 +286,10 @@ class ExportButtonFactory():
                                                           SCOPE_PRIVATE)
 
         # write out the document contents in the requested format
-        fileObject.file_path = os.path.join(activity.get_activity_root(),
-                                            'instance', '%i' % time.time())
+        fileObject.file_path = os.path.join(activity.image_store.directory,
+                                            '%i' % time.time())
+        # removed by the datastore, or else in the next collect
+        activity.image_store.add_temporary(fileObject.file_path)
         abi.save('file://' + fileObject.file_path,
                  format['mime_type'], exp_props)
 
@@ -206,6 +304,8 @@ class DocumentView(Abi.Widget):
     def __init__(self):
         Abi.init([])
         Abi.Widget.__init__(self)
+        # the toolbars receive the state signals through the aggregator
+        self.state = StateAggregator(self)
         self.connect('size-allocate', self.__size_allocate_cb)
         try:
             self.connect('request-clear-area', self.__request_clear_area_cb)
@@ -219,12 +319,221 @@ class DocumentView(Abi.Widget):
 
         self.osk_changed = False
         self.dy = 0
+        # the last allocation handled, and if a redraw is pending
+        self._allocation = None
+        self._redraw_pending = False
+        # the zoom requested, and the viewport image and its zoom, while
+        # the zoom is changing
+        self._zoom_target = None
+        self._zoom_preview = None
+        self._zoom_timeout_id = None
+        self.connect('draw', self.__zoom_preview_draw_cb)
+
+        self._draft_layout = False
+
+        self._paint_stats = None
+        if os.environ.get(PAINT_STATS_ENV):
+            self.enable_paint_stats()
+
+        # the revision changes every time the document can have changed,
+        # is used to know when the cached text is not valid anymore
+        self._revision = 0
+        self._load_revision = 0
+        self._snapshot = TextSnapshot()
+        self._outline = OutlineIndex()
+        # due to http://bugzilla.abisource.com/show_bug.cgi?id=13585
+        self._can_get_content = Abi._version != '3.0'
+        self._press_position = None
+        self.connect('key-press-event', self.__edit_key_press_cb)
+        self.connect('button-press-event', self.__edit_button_press_cb)
+        self.connect('button-release-event', self.__edit_button_release_cb)
+        self.connect('drag-data-received', self.__edit_drag_data_received_cb)
+        # how to undo the last batch operation (replace all, insert
+        # images) in a single step, see _set_batch_undo()
+        self._batch_undo = None
+        # the text searched by libabiword, and the number of occurrence
+        # selected and the revision when it was selected, if known
+        self._find_string = None
+        self._find_occurrence = None
+
+    def enable_paint_stats(self):
+        """
+        Measure the time from the input events to the next draw and paint
+        of the document, and the frame times, to compare the typing
+        latency between devices and libabiword versions.
+        """
+        if self._paint_stats is not None:
+            return
+        self._paint_stats = {'input-to-draw': Histogram(),
+                             'input-to-paint': Histogram(),
+                             'input-to-paint-print-layout': Histogram(),
+                             'input-to-paint-draft-layout': Histogram(),
+                             'frame-time': Histogram(),
+                             'size-allocate': 0,
+                             'size-allocate-unchanged': 0,
+                             'redraw-requested': 0,
+                             'redraw-done': 0,
+                             'queue-draw': 0}
+        self._input_time = None
+        self._drawn_input_time = None
+        self._frame_start = None
+        self.connect('key-press-event', self.__input_event_cb)
+        self.connect('button-press-event', self.__input_event_cb)
+        self.connect_after('draw', self.__stats_draw_cb)
+        if self.get_realized():
+            self.__stats_realize_cb(self)
+        else:
+            self.connect('realize', self.__stats_realize_cb)
+
+    def get_paint_stats(self):
+        if self._paint_stats is None:
+            return None
+        stats = {}
+        for name, value in self._paint_stats.items():
+            if isinstance(value, Histogram):
+                value = value.to_dict()
+            stats[name] = value
+        return stats
+
+    def __stats_realize_cb(self, widget):
+        frame_clock = self.get_frame_clock()
+        frame_clock.connect('before-paint', self.__before_paint_cb)
+        frame_clock.connect('after-paint', self.__after_paint_cb)
+
+    def __input_event_cb(self, widget, event):
+        if self._input_time is None:
+            self._input_time = time.time()
+        return False
+
+    def __stats_draw_cb(self, widget, cr):
+        if self._input_time is not None:
+            self._paint_stats['input-to-draw'].add(
+                (time.time() - self._input_time) * 1000)
+            self._drawn_input_time = self._input_time
+            self._input_time = None
+        return False
+
+    def __before_paint_cb(self, frame_clock):
+        self._frame_start = time.time()
+
+    def __after_paint_cb(self, frame_clock):
+        now = time.time()
+        if self._frame_start is not None:
+            self._paint_stats['frame-time'].add(
+                (now - self._frame_start) * 1000)
+            self._frame_start = None
+        if self._drawn_input_time is not None:
+            duration = (now - self._drawn_input_time) * 1000
+            self._paint_stats['input-to-paint'].add(duration)
+            # to compare the typing latency in both layouts
+            if self._draft_layout:
+                self._paint_stats['input-to-paint-draft-layout'].add(duration)
+            else:
+                self._paint_stats['input-to-paint-print-layout'].add(duration)
+            self._drawn_input_time = None
+
+    def queue_draw(self):
+        if self._paint_stats is not None:
+            self._paint_stats['queue-draw'] += 1
+        Abi.Widget.queue_draw(self)
 
     def __shallow_move_cb(self):
         self.moveto_right()
         return False
 
+    def queue_redraw(self):
+        """
+        Queue a draw in the next frame. However many times it is called
+        before, the document is drawn only once.
+        """
+        if self._paint_stats is not None:
+            self._paint_stats['redraw-requested'] += 1
+        if self._redraw_pending:
+            return
+        self._redraw_pending = True
+        if hasattr(self, 'add_tick_callback') and self.get_realized():
+            self.add_tick_callback(self.__redraw_tick_cb)
+        else:
+            # before gtk 3.8
+            GLib.idle_add(self.__redraw_idle_cb)
+
+    def __redraw_tick_cb(self, widget, frame_clock):
+        self.__redraw_idle_cb()
+        return False
+
+    def __redraw_idle_cb(self):
+        self._redraw_pending = False
+        if self._paint_stats is not None:
+            self._paint_stats['redraw-done'] += 1
+        self.queue_draw()
+        return False
+
+    def request_zoom(self, zoom):
+        """
+        Change the zoom once the requests stop. Meanwhile the last
+        rendered viewport is displayed scaled to the requested zoom.
+        """
+        if self._zoom_preview is None and self.get_realized():
+            x = y = 0
+            if not self.get_has_window():
+                allocation = self.get_allocation()
+                x, y = allocation.x, allocation.y
+            pixbuf = Gdk.pixbuf_get_from_window(
+                self.get_window(), x, y, self.get_allocated_width(),
+                self.get_allocated_height())
+            if pixbuf is not None:
+                self._zoom_preview = (pixbuf, self.get_zoom_percentage())
+        self._zoom_target = zoom
+        if self._zoom_timeout_id is not None:
+            GLib.source_remove(self._zoom_timeout_id)
+        self._zoom_timeout_id = GLib.timeout_add(ZOOM_DELAY,
+                                                 self.__zoom_timeout_cb)
+        self.queue_redraw()
+
+    def cancel_zoom_request(self):
+        if self._zoom_timeout_id is not None:
+            GLib.source_remove(self._zoom_timeout_id)
+            self._zoom_timeout_id = None
+        self._zoom_target = None
+        if self._zoom_preview is not None:
+            self._zoom_preview = None
+            self.queue_redraw()
+
+    def __zoom_timeout_cb(self):
+        self._zoom_timeout_id = None
+        zoom = self._zoom_target
+        self.cancel_zoom_request()
+        self.set_zoom_percentage(zoom)
+        return False
+
+    def __zoom_preview_draw_cb(self, widget, cr):
+        if self._zoom_preview is None:
+            return False
+        pixbuf, zoom = self._zoom_preview
+        scale = float(self._zoom_target) / zoom
+        cr.set_source_rgb(0.75, 0.75, 0.75)
+        cr.paint()
+        cr.scale(scale, scale)
+        Gdk.cairo_set_source_pixbuf(cr, pixbuf, 0, 0)
+        cr.paint()
+        # don't let libabiword draw
+        return True
+
+    def zoom_width(self):
+        self.cancel_zoom_request()
+        Abi.Widget.zoom_width(self)
+
     def __size_allocate_cb(self, widget, allocation):
+        if self._paint_stats is not None:
+            self._paint_stats['size-allocate'] += 1
+        current = (allocation.x, allocation.y, allocation.width,
+                   allocation.height, self.dy)
+        if current == self._allocation and not self.osk_changed:
+            # nothing to relayout or redraw
+            if self._paint_stats is not None:
+                self._paint_stats['size-allocate-unchanged'] += 1
+            return
+        self._allocation = current
         self.set_allocation(allocation)
 
         if self.get_child() is not None:
@@ -239,6 +548,8 @@ class DocumentView(Abi.Widget):
             GLib.timeout_add(100, self.__shallow_move_cb)
             self.osk_changed = False
 
+        self.queue_redraw()
+
     def __request_clear_area_cb(self, widget, clear, cursor):
         allocation = widget.get_allocation()
         allocation.x = 0
@@ -266,7 +577,547 @@ class DocumentView(Abi.Widget):
         self.queue_resize()
         return True
 
+    def __edit_key_press_cb(self, widget, event):
+        control = event.state & Gdk.ModifierType.CONTROL_MASK
+        if control and event.keyval in (Gdk.KEY_z, Gdk.KEY_Z) and \
+                self.can_undo_batch():
+            self.undo_batch()
+            return True
+        if event.keyval in _NAVIGATION_KEYS or \
+                (control and event.keyval in _CONTROL_READ_KEYS):
+            # only moves the cursor or the selection, or copies
+            return False
+        self._revision += 1
+        return False
+
+    def __edit_button_press_cb(self, widget, event):
+        self._press_position = (event.x, event.y)
+        return False
+
+    def __edit_button_release_cb(self, widget, event):
+        # a click only moves the cursor, dragging with the first button
+        # can move the selected text
+        if event.button == 1 and self._press_position is not None and \
+                not Gtk.drag_check_threshold(
+                    self, int(self._press_position[0]),
+                    int(self._press_position[1]), int(event.x),
+                    int(event.y)):
+            return False
+        self._revision += 1
+        return False
+
+    def __edit_drag_data_received_cb(self, widget, context, x, y, data,
+                                     info, time):
+        self._revision += 1
+
+    def get_revision(self):
+        return self._revision
+
+    def get_snapshot(self):
+        """
+        Return the TextSnapshot of the document, updated if the document
+        changed, or None if libabiword can't provide the text.
+        """
+        if not self._can_get_content:
+            return None
+        if self._snapshot.revision != self._revision:
+            self._snapshot.update(self.get_content('text/plain', None),
+                                  self._revision)
+        return self._snapshot
+
+    def can_draft_layout(self):
+        return hasattr(Abi.Widget, 'view_normal_layout')
+
+    def set_draft_layout(self, draft):
+        """
+        Use the normal layout, without pages, faster to edit long
+        documents, or the print layout.
+        """
+        self._draft_layout = draft and self.can_draft_layout()
+        if self._draft_layout:
+            self.view_normal_layout()
+        else:
+            self.view_print_layout()
+
+    def get_draft_layout(self):
+        return self._draft_layout
+
+    def get_outline(self):
+        """
+        Return the OutlineIndex of the document, updated if the document
+        changed, or None if libabiword can't provide the content.
+        """
+        if not self._can_get_content:
+            return None
+        if self._outline.revision != self._revision:
+            self._outline.update(
+                self.get_content('application/x-abiword', None),
+                self._revision)
+        return self._outline
+
+    def set_find_string(self, text):
+        self._find_string = text
+        self._find_occurrence = None
+        Abi.Widget.set_find_string(self, text)
+
+    def get_find_string(self):
+        return self._find_string
+
+    def find_next(self, select):
+        self._find_occurrence = None
+        return Abi.Widget.find_next(self, select)
+
+    def find_prev(self):
+        self._find_occurrence = None
+        return Abi.Widget.find_prev(self)
+
+    def select_occurrence(self, text, occurrence, total):
+        """
+        Select an occurrence of text, counting from the beginning of the
+        document as the case insensitive libabiword search does, of the
+        total in the document. If the selected occurrence of the same text
+        is adjacent, and the document did not change, only searches once
+        from it, else searches from the nearer end of the document.
+
+        Return False if the occurrence is too far from both ends, and the
+        next occurrence from the cursor was selected instead.
+        """
+        same_text = self._find_string is not None and \
+            self._find_string.decode('utf-8').lower() == \
+            text.decode('utf-8').lower()
+        adjacent = same_text and self._find_occurrence is not None and \
+            self._find_occurrence[1] == self._revision and \
+            abs(occurrence - self._find_occurrence[0]) <= 1
+        if not same_text:
+            self.set_find_string(text)
+
+        from_end = total - occurrence
+        if adjacent:
+            if occurrence > self._find_occurrence[0]:
+                Abi.Widget.find_next(self, False)
+            elif occurrence < self._find_occurrence[0]:
+                Abi.Widget.find_prev(self)
+        elif min(occurrence + 1, from_end) > MAX_FIND_STEPS:
+            Abi.Widget.find_next(self, False)
+            self._find_occurrence = None
+            return False
+        elif occurrence + 1 <= from_end:
+            self.moveto_bod()
+            for i in range(occurrence + 1):
+                Abi.Widget.find_next(self, False)
+        else:
+            self.moveto_eod()
+            for i in range(from_end):
+                Abi.Widget.find_prev(self)
+        self._find_occurrence = (occurrence, self._revision)
+        return True
+
+    def get_cursor_offset(self):
+        """
+        Return the offset in the text snapshot of the cursor, or of the
+        beginning of the selection, or None if libabiword can't provide
+        the text. The text after the cursor is selected to count it, then
+        the cursor is moved back.
+        """
+        snapshot = self.get_snapshot()
+        if snapshot is None:
+            return None
+        window = self.get_window()
+        if window is not None:
+            window.freeze_updates()
+        try:
+            Abi.Widget.invoke_ex(self, 'extSelEOD', '', 0, 0)
+            text, length = self.get_selection('text/plain')
+            if text and length > 0:
+                # back to the beginning of the selection
+                Abi.Widget.invoke_ex(self, 'warpInsPtLeft', '', 0, 0)
+        finally:
+            if window is not None:
+                window.thaw_updates()
+        after = text.decode('utf-8') if text and length > 0 else u''
+        return max(0, len(snapshot.get_folded_text()) - len(after))
+
+    def select_next_occurrence(self, text, skipped, occurrence):
+        """
+        Select an occurrence of text searching from the cursor, after
+        skipping the first ones found. occurrence is its number from the
+        beginning of the document, to select the adjacent ones later with
+        a single search.
+
+        Return False without searching if more than MAX_FIND_STEPS have
+        to be skipped, or if the occurrence was not found.
+        """
+        if skipped >= MAX_FIND_STEPS:
+            return False
+        if self._find_string is None or \
+                self._find_string.decode('utf-8').lower() != \
+                text.decode('utf-8').lower():
+            self.set_find_string(text)
+        self._find_occurrence = None
+        for i in range(skipped + 1):
+            if not Abi.Widget.find_next(self, False):
+                return False
+        self._find_occurrence = (occurrence, self._revision)
+        return True
+
+    def select_in_paragraph(self, paragraph, text):
+        """
+        Select the first occurrence of text from the beginning of a
+        paragraph, counting the paragraphs from the beginning of the
+        document. Moving by paragraphs is slower than searching from an
+        end of the document, but does not depend on how many times the
+        text is repeated. Return False if the text was not found.
+        """
+        window = self.get_window()
+        if window is not None:
+            window.freeze_updates()
+        try:
+            self.moveto_bod()
+            for i in range(paragraph):
+                if not Abi.Widget.invoke_ex(self, 'warpInsPtEOP', '', 0, 0) \
+                        or not Abi.Widget.invoke_ex(self, 'warpInsPtRight',
+                                                    '', 0, 0):
+                    break
+            self.set_find_string(text)
+            return Abi.Widget.find_next(self, False)
+        finally:
+            if window is not None:
+                window.thaw_updates()
+
+    def replace_all(self, pattern, replacement, regex):
+        """
+        Replace all the matches of the compiled pattern, as a single
+        operation painted once and removed by undo_batch(). Return the
+        number of replacements, or None if libabiword can't provide the
+        document text.
+
+        libabiword has no api to replace, every match is selected with
+        the libabiword search and the replacement typed over it. The
+        document is still laid out after every replacement, only the
+        painting and the undo are done once.
+        """
+        snapshot = self.get_snapshot()
+        if snapshot is None:
+            return None
+        # computed before changing the document, to fail on invalid
+        # group references without changes
+        replacements = plan_replacements(snapshot, pattern, replacement,
+                                         regex)
+        if not replacements:
+            return 0
+
+        window = self._begin_batch()
+        steps = 0
+        try:
+            self.moveto_bod()
+            for text, skipped, new_text in replacements:
+                if self._find_string is None or \
+                        self._find_string.decode('utf-8').lower() != \
+                        text.decode('utf-8').lower():
+                    self.set_find_string(text)
+                for i in range(skipped + 1):
+                    if not Abi.Widget.find_next(self, False):
+                        return steps
+                if new_text:
+                    done = Abi.Widget.invoke_ex(self, 'insertData', new_text,
+                                                0, 0)
+                else:
+                    done = Abi.Widget.invoke_ex(self, 'delLeft', '', 0, 0)
+                if not done:
+                    return steps
+                steps += 1
+            return steps
+        finally:
+            self._find_occurrence = None
+            self._end_batch(window, steps)
+
+    def insert_table_with_data(self, rows):
+        """
+        Insert a table filled with rows, a list of lists of cell texts,
+        as a single operation painted once and removed by undo_batch().
+        Return False if the table or a cell text could not be inserted.
+
+        libabiword has no api to fill a table, the text of every cell is
+        typed, moving to the next cell with tab. The table is still laid
+        out after every cell, only the painting and the undo are done
+        once.
+        """
+        window = self._begin_batch()
+        steps = 0
+        try:
+            if not Abi.Widget.insert_table(self, len(rows), len(rows[0])):
+                return False
+            steps += 1
+            for row_index, row in enumerate(rows):
+                for column, text in enumerate(row):
+                    # tab in the last cell would add a row
+                    if (row_index > 0 or column > 0) and \
+                            not Abi.Widget.invoke_ex(self, 'insertTab', '',
+                                                     0, 0):
+                        return False
+                    for i, line in enumerate(text.strip().split('\n')):
+                        line = line.strip('\r')
+                        if i > 0:
+                            if not Abi.Widget.invoke_ex(
+                                    self, 'insertLineBreak', '', 0, 0):
+                                return False
+                            steps += 1
+                        if line:
+                            if not Abi.Widget.invoke_ex(self, 'insertData',
+                                                        line, 0, 0):
+                                return False
+                            steps += 1
+            return True
+        finally:
+            self._end_batch(window, steps)
+
+    def insert_images(self, file_paths, floating):
+        """
+        Insert several images as a single operation painted once and
+        removed by undo_batch().
+
+        libabiword has no api to insert several images at once, the
+        document is still laid out after every image, only the painting
+        and the undo are done once.
+        """
+        window = self._begin_batch()
+        steps = 0
+        try:
+            for file_path in file_paths:
+                if Abi.Widget.insert_image(self, file_path, floating):
+                    steps += 1
+        finally:
+            self._end_batch(window, steps)
+
+    def invoke_repeated(self, method, count):
+        """
+        Invoke an edit method up to count times, like inserting or
+        deleting several table rows, as a single operation painted once
+        and removed by undo_batch(). Stops when the method fails, like
+        deleting rows when the table is gone.
+
+        libabiword has no api to insert or delete several rows or
+        columns at once, the table is still laid out after every call,
+        only the painting and the undo are done once.
+        """
+        window = self._begin_batch()
+        steps = 0
+        try:
+            for i in range(count):
+                if not Abi.Widget.invoke_ex(self, method, '', 0, 0):
+                    break
+                steps += 1
+        finally:
+            self._end_batch(window, steps)
+
+    def _begin_batch(self):
+        # don't paint until _end_batch()
+        self.discard_batch_undo()
+        window = self.get_window()
+        if window is not None:
+            window.freeze_updates()
+        return window
+
+    def _end_batch(self, window, steps):
+        if window is not None:
+            window.thaw_updates()
+        self._revision += 1
+        if steps > 0:
+            # the batch is undone undoing steps in libabiword, while the
+            # document did not change after it
+            self._batch_undo = (steps, self._revision)
+
+    def can_undo_batch(self):
+        """
+        True if the document did not change since the last batch
+        operation, only moving the cursor or selecting keeps it.
+        """
+        return self._batch_undo is not None and \
+            self._batch_undo[1] == self._revision
+
+    def undo_batch(self):
+        steps, revision = self._batch_undo
+        self._batch_undo = None
+        window = self.get_window()
+        if window is not None:
+            window.freeze_updates()
+        try:
+            for i in range(steps):
+                Abi.Widget.undo(self)
+        finally:
+            if window is not None:
+                window.thaw_updates()
+        self._revision += 1
+
+    def discard_batch_undo(self):
+        self._batch_undo = None
+
+    def load_file(self, uri, mime_type):
+        self._revision += 1
+        self._load_revision = self._revision
+        return Abi.Widget.load_file(self, uri, mime_type)
+
+    def get_load_revision(self):
+        """Revision when the whole document was last loaded"""
+        return self._load_revision
+
+    def paste(self):
+        self._revision += 1
+        Abi.Widget.paste(self)
+
+    def undo(self):
+        if self.can_undo_batch():
+            self.undo_batch()
+            return
+        self._revision += 1
+        Abi.Widget.undo(self)
+
+    def redo(self):
+        self._revision += 1
+        Abi.Widget.redo(self)
+
+    def insert_image(self, file_path, floating):
+        self._revision += 1
+        Abi.Widget.insert_image(self, file_path, floating)
+
+    def set_style(self, style_name):
+        self._revision += 1
+        Abi.Widget.set_style(self, style_name)
+
+    def insert_table(self, rows, cols):
+        self._revision += 1
+        Abi.Widget.insert_table(self, rows, cols)
+
+    def invoke_ex(self, method, data, x, y):
+        self._revision += 1
+        return Abi.Widget.invoke_ex(self, method, data, x, y)
+
     def get_version(self):
         version = Abi._version
         logging.error('Abiword version %s', version)
         return version
+
+
+class PaintStatsOverlay(Gtk.Label):
+    """Display the DocumentView paint statistics over the document"""
+
+    def __init__(self, document_view):
+        Gtk.Label.__init__(self)
+        self._document_view = document_view
+        self.props.halign = Gtk.Align.END
+        self.props.valign = Gtk.Align.START
+        self.set_margin_right(20)
+        self.set_margin_top(20)
+        self.update()
+        GLib.timeout_add_seconds(1, self.update)
+
+    def update(self):
+        stats = self._document_view.get_paint_stats()
+        if stats is None:
+            return False
+        self.set_markup(
+            '<span background="#ffffff" font="Monospace 9">'
+            'input to paint p50 %d p95 %d ms\n'
+            'frame time p50 %d p95 %d ms\n'
+            'size allocate %d (%d unchanged) queue draw %d\n'
+            'redraw %d of %d requested</span>' % (
+                stats['input-to-paint']['p50_ms'],
+                stats['input-to-paint']['p95_ms'],
+                stats['frame-time']['p50_ms'],
+                stats['frame-time']['p95_ms'],
+                stats['size-allocate'], stats['size-allocate-unchanged'],
+                stats['queue-draw'], stats['redraw-done'],
+                stats['redraw-requested']))
+        return True
+
+
+class OutlinePanel(Gtk.ScrolledWindow):
+    """
+    List of the headings of the document, activating a heading moves
+    the cursor to it. Only updated while visible.
+    """
+
+    def __init__(self, document_view):
+        Gtk.ScrolledWindow.__init__(self)
+        self._document_view = document_view
+        self._outline = None
+        self._timeout_id = None
+        # the revision seen by the last poll, and if the paragraph style
+        # changed since
+        self._last_revision = None
+        self._style_changed = False
+        self.set_policy(Gtk.PolicyType.NEVER, Gtk.PolicyType.AUTOMATIC)
+        self.set_size_request(style.GRID_CELL_SIZE * 4, -1)
+
+        self._store = Gtk.ListStore(str, int)
+        tree_view = Gtk.TreeView(self._store)
+        tree_view.props.headers_visible = False
+        renderer = Gtk.CellRendererText()
+        renderer.props.ellipsize = Pango.EllipsizeMode.END
+        column = Gtk.TreeViewColumn('', renderer, text=0)
+        column.set_cell_data_func(renderer, self.__heading_data_cb)
+        tree_view.append_column(column)
+        tree_view.connect('row-activated', self.__row_activated_cb)
+        tree_view.show()
+        self.add(tree_view)
+
+        document_view.state.connect(self, 'style-name', self.__style_name_cb)
+        self.connect('map', self.__map_cb)
+        self.connect('unmap', self.__unmap_cb)
+
+    def __heading_data_cb(self, column, renderer, model, tree_iter, data):
+        level = model.get_value(tree_iter, 1)
+        renderer.props.xpad = (level - 1) * style.DEFAULT_PADDING * 2
+        renderer.props.weight = Pango.Weight.BOLD if level == 1 else \
+            Pango.Weight.NORMAL
+
+    def __map_cb(self, widget):
+        if self._outline is None:
+            self._outline = self._document_view.get_outline()
+            if self._outline is None:
+                return
+            self._outline.connect('changed', self.__outline_changed_cb)
+            self.__outline_changed_cb(self._outline, 0, 0,
+                                      len(self._outline.headings))
+        self._document_view.get_outline()
+        self._last_revision = self._document_view.get_revision()
+        self._timeout_id = GLib.timeout_add(OUTLINE_DELAY, self.update)
+
+    def __unmap_cb(self, widget):
+        if self._timeout_id is not None:
+            GLib.source_remove(self._timeout_id)
+            self._timeout_id = None
+
+    def __style_name_cb(self, document_view, style_name):
+        # a paragraph style can have changed, update at the next poll
+        # even while typing
+        self._style_changed = True
+
+    def update(self):
+        # get_outline() exports the whole document, wait until the
+        # revision did not change for a poll, and then it updates the
+        # index, and the list with it, only if the document changed
+        revision = self._document_view.get_revision()
+        if revision == self._last_revision or self._style_changed:
+            self._style_changed = False
+            self._document_view.get_outline()
+        self._last_revision = revision
+        return True
+
+    def __outline_changed_cb(self, outline, first, old_end, new_end):
+        for i in range(first, old_end):
+            self._store.remove(self._store.get_iter(first))
+        for i in range(first, new_end):
+            paragraph, level, text = outline.headings[i]
+            self._store.insert(i, [text.encode('utf-8'), level])
+
+    def __row_activated_cb(self, tree_view, path, column):
+        index = path.get_indices()[0]
+        text, occurrence, total = self._outline.get_target(index)
+        if not self._document_view.select_occurrence(text, occurrence,
+                                                     total):
+            # the heading text is repeated too many times to search it
+            paragraph = self._outline.headings[index][0]
+            if not self._document_view.select_in_paragraph(paragraph, text):
+                logger.warning('Could not select the heading %r', text)
+        self._document_view.grab_focus()